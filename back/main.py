@@ -1,74 +1,104 @@
 # main.py
+import os
 import time
 import threading
-import binascii
+import queue
+import logging
+import logging.handlers
+import concurrent.futures
 from typing import Optional
-from contextlib import asynccontextmanager
-import uuid
-import usb.core
-import usb.util
-import nfc
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import dataclass
+from functools import lru_cache
 from ndef import TextRecord
 from sqlmodel import SQLModel, Session, Field, create_engine, select
-from sqlalchemy import func
+from sqlalchemy import event, case, func, and_, not_, true, bindparam, insert, update, delete, Index, text
+from sqlalchemy.orm import sessionmaker
 from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException, Depends, status, Request, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, Query, status, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import datetime, timedelta, timezone
-from enum import Enum
+from datetime import datetime, timedelta
+from enum import Enum, IntEnum
 import secrets
 import hashlib
+import hmac
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
 import jwt
-import json
+import orjson
 import asyncio
+from cachetools import TTLCache
+
+# --- Logging ---
+# Records go through a queue so the NFC thread never blocks on a stdout write;
+# a listener thread does the formatting and I/O.
+log = logging.getLogger("nfc")
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
 
 # WebSocket manager for handling connections
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
-        self.pending_messages = []
-        self._lock = threading.Lock()
+        # Keyed by id(): WebSocket is a Mapping, so it isn't hashable itself
+        self.active_connections: dict[int, WebSocket] = {}
+        # Bound to the serving loop by start(); until then (tests, no lifespan) messages are dropped
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional["asyncio.Queue[dict]"] = None
+
+    def start(self):
+        """Bind the message queue to the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections[id(websocket)] = websocket
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        # Also reached after broadcast() already dropped a failed client
+        self.active_connections.pop(id(websocket), None)
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
         await websocket.send_text(message)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
+        # Send to every client at once so a slow one doesn't hold up the rest
+        connections = list(self.active_connections.values())
+        results = await asyncio.gather(*(c.send_text(message) for c in connections), return_exceptions=True)
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
                 # Remove disconnected clients
-                self.active_connections.remove(connection)
+                self.disconnect(connection)
 
     def queue_message(self, message: dict):
         """Thread-safe method to queue WebSocket messages"""
-        with self._lock:
-            self.pending_messages.append(message)
+        if self._loop is None:
+            return
+        try:
+            # Wakes process_messages() right away instead of on its next poll
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, message)
+        except RuntimeError:
+            pass  # loop already closed during shutdown
 
-    async def process_pending_messages(self):
-        """Process pending WebSocket messages"""
-        with self._lock:
-            if not self.pending_messages:
-                return
-            
-            messages_to_send = self.pending_messages.copy()
-            self.pending_messages.clear()
-        
-        for message in messages_to_send:
+    async def process_messages(self):
+        """Broadcast queued messages as they arrive; runs until cancelled"""
+        while True:
+            message = await self._queue.get()
             try:
-                await self.broadcast(json.dumps(message))
+                # Encoded once, whatever the number of clients
+                await self.broadcast(orjson.dumps(message).decode())
             except Exception as e:
-                print(f"Error broadcasting message: {e}")
+                log.warning("Error broadcasting message: %r", e)
 
 manager = ConnectionManager()
 
@@ -78,9 +108,20 @@ class UserRole(str, Enum):
     IT_STAFF = "it_staff"  # Auth Level 2 - Mass operations, system management
     ADMIN = "admin"  # Auth Level 3 - Full system access
 
+ROLE_AUTH_LEVEL = {
+    UserRole.TEACHER: 1,
+    UserRole.IT_STAFF: 2,
+    UserRole.ADMIN: 3,
+}
+
 class User(SQLModel, table=True):
+    # Partial unique index: at most one teacher on duty, and the duty lookup reads one entry
+    __table_args__ = (
+        Index("ix_user_on_duty", "assigned_duty", unique=True,
+              sqlite_where=text("assigned_duty = 1"), postgresql_where=text("assigned_duty")),
+    )
     id: int | None = Field(default=None, primary_key=True)
-    name: str 
+    name: str = Field(index=True)  # Not unique in the schema; /register rejects duplicates
     is_active: bool = Field(default=True) 
     role: UserRole = Field(default=UserRole.TEACHER)
     auth_level: int = Field(default=1)  # 0=student, 1=teacher, 2=it_staff, 3=admin
@@ -88,8 +129,8 @@ class User(SQLModel, table=True):
     assigned_duty: Optional[bool] = Field(default=False)  # For daily "janitor" duty
 class Student(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    tid: str
-    name: str
+    tid: str = Field(index=True)  # Not unique: students without a tag yet share ""
+    name: str = Field(index=True)  # duplicate-name checks on create, and tag registration by name
     lastscan: int
     in_school: bool
     schoolclass: str = Field(default="", sa_column_kwargs={"name": "schoolclass"})
@@ -98,13 +139,15 @@ class StudentCreate(BaseModel):
     name: str
     class_name: str
 class AuditLog(SQLModel, table=True):
+    # Check-in log pages filter on action and read newest first; the audit views just read newest first
+    __table_args__ = (Index("ix_auditlog_action_timestamp", "action", "timestamp"),)
     id: int | None = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id")
     action: str
     target_type: str  # "user", "token", "system", etc.
     target_id: Optional[str] = None
     details: Optional[str] = None
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=datetime.utcnow, index=True)
     ip_address: Optional[str] = None
     user_agent: Optional[str] = None
 
@@ -119,6 +162,14 @@ class TokenData(BaseModel):
     user_id: Optional[int] = None
     role: Optional[UserRole] = None
 
+class AuthedUser(BaseModel):
+    """The columns the auth dependencies and endpoints read from the current user"""
+    id: int
+    name: str
+    role: UserRole
+    auth_level: int
+    is_active: bool
+
 class UserLogin(BaseModel):
     username: str
     password: str
@@ -130,48 +181,265 @@ class UserCreate(BaseModel):
     assigned_duty: bool = False
     is_active: bool = True
 
-class newUser(BaseModel):
-    id: int | None = Field(default=None, primary_key=True)
-    tid: str
-    name: str
-    lastscan: int
-    in_school: bool
+class NewTag(BaseModel):
+    id: int  # Student to register the tag for; other fields in the body are ignored
 
 # --- Database Setup ---
-engine = create_engine("sqlite:///./nfctag.db")
-SQLModel.metadata.create_all(engine)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./nfctag.db")
+if DATABASE_URL.startswith("sqlite"):
+    # Pooled connections are handed between the event loop, the threadpool and the scan thread
+    _connect_args = {"timeout": 10, "check_same_thread": False}
+else:
+    # Postgres: JIT only slows down the tiny point lookups this app issues
+    _connect_args = {"connect_timeout": 10, "application_name": "nfc", "options": "-c jit=off"}
+    if DATABASE_URL.startswith("postgresql+psycopg://"):
+        # psycopg 3 prepares a statement server-side once it has run this many times, so the
+        # per-tap lookups skip parse/plan. PgBouncer in transaction mode can't hold prepared
+        # statements across transactions: set PGBOUNCER=1 to disable it there.
+        _connect_args["prepare_threshold"] = None if os.getenv("PGBOUNCER") else 2
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+    pool_timeout=30,
+    echo=False,
+    connect_args=_connect_args,
+)
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets the scan thread write a tap while endpoints keep reading;
+        # NORMAL only fsyncs at checkpoints, which is safe in WAL mode
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # Sort/temp b-trees in RAM, and reads served from a shared memory map instead of read() copies
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
+def init_db():
+    """Create missing tables and indexes. Called from lifespan rather than at import, and can be
+    switched off with AUTO_CREATE_TABLES=0 when the schema is managed by migrations"""
+    SQLModel.metadata.create_all(engine)
+    # Databases from before ix_user_on_duty can have several teachers on duty, which would
+    # stop the unique index from being created; keep the earliest of them
+    with engine.begin() as conn:
+        first_on_duty = select(func.min(User.id)).where(User.assigned_duty == True).scalar_subquery()
+        cleared = conn.execute(
+            update(User).where(User.assigned_duty == True, User.id != first_on_duty).values(assigned_duty=False)
+        ).rowcount
+    if cleared:
+        log.warning("Cleared duty from %d extra teacher(s) so only one is on duty", cleared)
+    # create_all() skips tables that already exist, so add any indexes declared since
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+# expire_on_commit=False: handlers read what they just wrote without reloading it
+SessionLocal = sessionmaker(engine, class_=Session, expire_on_commit=False)
+
+def get_session():
+    """Request-scoped session for endpoints"""
+    with SessionLocal() as session:
+        yield session
+
+def json_array(session: Session, stmt, params: Optional[dict] = None):
+    """Yield the rows of stmt as a JSON array, encoded one row at a time as the cursor yields them"""
+    yield b"["
+    sep = b""
+    for row in session.exec(stmt.execution_options(yield_per=256), params=params):
+        # Mixed-case column names come back as quoted_name, a str subclass orjson only takes with OPT_NON_STR_KEYS
+        yield sep + orjson.dumps(row._asdict(), option=orjson.OPT_NON_STR_KEYS)
+        sep = b","
+    yield b"]"
+
+def stream_rows(key: str, stmt, params: Optional[dict] = None):
+    """Respond with {key: [rows]} encoded row by row as the cursor yields them, so memory
+    and time to first byte don't grow with the result size"""
+    def body():
+        # Own session: the response body is sent after the request's dependencies have closed
+        with SessionLocal() as session:
+            yield b'{"' + key.encode() + b'":'
+            yield from json_array(session, stmt, params)
+            yield b"}"
+    return StreamingResponse(body(), media_type="application/json")
+
+# Hot-path statements built once so SQLAlchemy's compiled cache is reused per tap.
+# They select plain columns and update through Core, so a tap never builds ORM instances.
+_DUTY_TEACHER = select(User.id, User.name).where(User.assigned_duty == True).limit(1)
+# A tap is one statement: find the student by tag, flip in_school and hand back the new state.
+# tid isn't unique, so the subquery keeps it to the first match as the old select did.
+_FLIP_STUDENT_STATUS = (
+    update(Student)
+    .where(Student.id == select(Student.id).where(Student.tid == bindparam("tag")).limit(1).scalar_subquery())
+    .values(in_school=not_(Student.in_school), lastscan=bindparam("scan_time"))
+    .returning(Student.id, Student.name, Student.in_school)
+)
+
+# (id, name) of the teacher on duty, or None if nobody is. It changes a few times a day,
+# so taps read it from memory; endpoints that can change it call invalidate_duty_teacher().
+_DUTY_UNSET = object()
+_duty_cache = _DUTY_UNSET
+_duty_cache_lock = threading.Lock()
+
+def get_duty_teacher(session: Session):
+    global _duty_cache
+    # Loading under the lock keeps a read that started before an invalidation from re-caching stale data
+    with _duty_cache_lock:
+        if _duty_cache is _DUTY_UNSET:
+            row = session.exec(_DUTY_TEACHER).first()
+            _duty_cache = (row.id, row.name) if row else None
+        return _duty_cache
+
+def invalidate_duty_teacher():
+    global _duty_cache
+    with _duty_cache_lock:
+        _duty_cache = _DUTY_UNSET
+
+# Encoded /teacher/check-in-status body. Dashboards poll it far more often than students
+# change, so it is rebuilt only after a write to Student calls invalidate_check_in_status().
+_status_body: Optional[bytes] = None
+_status_lock = threading.Lock()
+
+def invalidate_check_in_status():
+    global _status_body
+    with _status_lock:
+        _status_body = None
 
 # --- Authentication Configuration ---
-SECRET_KEY = secrets.token_urlsafe(32)
-ALGORITHM = "HS256"
+# Tokens only survive a restart if the key does. JWT_PRIVATE_KEY_PATH/JWT_PUBLIC_KEY_PATH
+# (Ed25519 PEM files) switch signing to EdDSA; otherwise HS256 with JWT_SECRET, falling
+# back to a per-process random secret that logs everyone out on restart.
+_private_key_path = os.getenv("JWT_PRIVATE_KEY_PATH")
+_public_key_path = os.getenv("JWT_PUBLIC_KEY_PATH")
+if _private_key_path and _public_key_path:
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
+    # Parsed once here; PyJWT would re-parse PEM bytes on every encode/decode
+    with open(_private_key_path, "rb") as f:
+        SECRET_KEY = load_pem_private_key(f.read(), password=None)
+    with open(_public_key_path, "rb") as f:
+        PUBLIC_KEY = load_pem_public_key(f.read())
+    ALGORITHM = "EdDSA"
+else:
+    # Encoded once here; PyJWT would otherwise encode a str secret on every encode/decode
+    SECRET_KEY = PUBLIC_KEY = (os.getenv("JWT_SECRET") or secrets.token_urlsafe(32)).encode()
+    ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Argon2id with the OWASP parameters (64 MiB, 3 passes); salt and parameters live in the hash string
+pwd_hasher = PasswordHasher(time_cost=3, memory_cost=64 * 1024, parallelism=2, hash_len=32, salt_len=16)
 
 # --- Authentication Functions ---
+def _is_legacy_hash(hashed_password):
+    # Accounts created before Argon2 store an unsalted SHA-256 hex digest
+    return not hashed_password.startswith("$argon2")
+
 def verify_password(plain_password, hashed_password):
-    return hashlib.sha256(plain_password.encode()).hexdigest() == hashed_password
+    if not hashed_password:
+        return False
+    if _is_legacy_hash(hashed_password):
+        return hmac.compare_digest(hashlib.sha256(plain_password.encode()).hexdigest(), hashed_password)
+    try:
+        return pwd_hasher.verify(hashed_password, plain_password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
 
 def get_password_hash(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    return pwd_hasher.hash(password)
+
+def password_needs_rehash(hashed_password):
+    return _is_legacy_hash(hashed_password) or pwd_hasher.check_needs_rehash(hashed_password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
-    else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    # Integer epoch seconds: PyJWT takes them as-is, no datetime built per token
+    now = int(time.time())
+    to_encode["iat"] = now
+    to_encode["exp"] = now + (int(expires_delta.total_seconds()) if expires_delta else 15 * 60)
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Recent successful logins, so a client logging in again (retries, several tabs) skips the
+# Argon2 verify. Keys are a BLAKE2b MAC under a per-process secret: neither the password nor
+# an offline-attackable hash of it is kept in memory.
+_login_cache = TTLCache(maxsize=1024, ttl=60)
+_login_cache_lock = threading.Lock()
+_LOGIN_CACHE_KEY = secrets.token_bytes(32)
+
 def authenticate_user(session: Session, username: str, password: str):
+    cache_key = hashlib.blake2b(f"{username}\0{password}".encode(), key=_LOGIN_CACHE_KEY, digest_size=16).digest()
+    with _login_cache_lock:
+        user_id = _login_cache.get(cache_key)
+    if user_id is not None:
+        user = session.get(User, user_id)
+        if user is not None and user.name == username:
+            return user
     user = session.exec(select(User).where(User.name == username)).first()
     if not user or not verify_password(password, user.hashed_password):
         return False
+    # Upgrade SHA-256 or outdated Argon2 hashes while we still have the plain password;
+    # the caller's commit (with the login audit entry) persists it
+    if password_needs_rehash(user.hashed_password):
+        user.hashed_password = get_password_hash(password)
+        session.add(user)
+    with _login_cache_lock:
+        _login_cache[cache_key] = user.id
     return user
 
-def log_action(session: Session, user_id: int, action: str, target_type: str, target_id: Optional[str] = None, details: Optional[str] = None, ip_address: Optional[str] = None, user_agent: Optional[str] = None):
-    """Log user actions for audit purposes"""
-    log_entry = AuditLog(
+class AuditEventClass(IntEnum):
+    """What an audited action does, in the order AUDIT_TRAIL_LEVEL cuts them off"""
+    READ = 0
+    SYSTEM = 1
+    CREATE = 2
+    UPDATE = 3
+    DELETE = 4
+
+AUDIT_EVENT_CLASS = {
+    "system_report_generated": AuditEventClass.READ,
+    "data_exported": AuditEventClass.READ,
+    "nfc_scan_error": AuditEventClass.SYSTEM,
+    "backup_created": AuditEventClass.SYSTEM,
+    "maintenance_performed": AuditEventClass.SYSTEM,
+    "emergency_shutdown": AuditEventClass.SYSTEM,
+    "user_registered": AuditEventClass.CREATE,
+    "student_created": AuditEventClass.CREATE,
+    "check_in_with_duty_teacher": AuditEventClass.UPDATE,
+    "check_out_with_duty_teacher": AuditEventClass.UPDATE,
+    "recorded_check_in": AuditEventClass.UPDATE,
+    "recorded_check_out": AuditEventClass.UPDATE,
+    "duty_assigned": AuditEventClass.UPDATE,
+    "tag_registered": AuditEventClass.UPDATE,
+    "system_config_updated": AuditEventClass.UPDATE,
+    "user_role_updated": AuditEventClass.UPDATE,
+    "user_activated": AuditEventClass.UPDATE,
+    "user_deactivated": AuditEventClass.UPDATE,
+    "student_deleted": AuditEventClass.DELETE,
+    "user_deleted": AuditEventClass.DELETE,
+}
+# Lowest event class recorded for each AUDIT_TRAIL_LEVEL
+AUDIT_TRAIL_LEVELS = {
+    "all": AuditEventClass.READ,
+    "writes_only": AuditEventClass.CREATE,
+    "mutations_only": AuditEventClass.UPDATE,
+    "deletes_only": AuditEventClass.DELETE,
+}
+AUDIT_TRAIL_LEVEL = os.getenv("AUDIT_TRAIL_LEVEL", "all")
+if AUDIT_TRAIL_LEVEL not in AUDIT_TRAIL_LEVELS:
+    raise ValueError(f"AUDIT_TRAIL_LEVEL must be one of {', '.join(AUDIT_TRAIL_LEVELS)}, not {AUDIT_TRAIL_LEVEL!r}")
+_audit_min_class = AUDIT_TRAIL_LEVELS[AUDIT_TRAIL_LEVEL]
+
+def audit_enabled(action: str) -> bool:
+    # Actions missing from AUDIT_EVENT_CLASS are always recorded; user_login is left out
+    # on purpose, since logins are security events whatever the level
+    event_class = AUDIT_EVENT_CLASS.get(action)
+    return event_class is None or event_class >= _audit_min_class
+
+def build_log(user_id: int, action: str, target_type: str, target_id: Optional[str] = None, details: Optional[str] = None, ip_address: Optional[str] = None, user_agent: Optional[str] = None):
+    """Build an audit entry for the caller to add to its own transaction"""
+    return AuditLog(
         user_id=user_id,
         action=action,
         target_type=target_type,
@@ -180,43 +448,190 @@ def log_action(session: Session, user_id: int, action: str, target_type: str, ta
         ip_address=ip_address,
         user_agent=user_agent
     )
-    session.add(log_entry)
-    session.commit()
+
+# Audit entries that aren't part of another write are buffered and inserted in batches by
+# audit_flusher() rather than committed one per request. Until lifespan starts the flusher
+# (tests, scripts) enqueue_audit() writes them straight away.
+AUDIT_BUFFER_MAX = 500
+AUDIT_FLUSH_INTERVAL = 5.0  # seconds an entry may wait for a batch to fill
+_audit_queue: "queue.Queue[Optional[dict]]" = queue.Queue()  # None tells the flusher to stop
+_audit_flusher_running = False
+
+def _write_audit_rows(rows: list[dict]):
+    # Core executemany in one transaction: no ORM instances or unit-of-work flush per row
+    with SessionLocal() as session:
+        session.exec(insert(AuditLog), params=rows)
+        session.commit()
+
+def add_log(session: Session, user_id: int, action: str, target_type: str, target_id: Optional[str] = None, details: Optional[str] = None, ip_address: Optional[str] = None, user_agent: Optional[str] = None):
+    """Add an audit entry to the caller's transaction, unless AUDIT_TRAIL_LEVEL skips the action"""
+    if audit_enabled(action):
+        session.add(build_log(user_id, action, target_type, target_id, details, ip_address, user_agent))
+
+def enqueue_audit(user_id: int, action: str, target_type: str, target_id: Optional[str] = None, details: Optional[str] = None, ip_address: Optional[str] = None, user_agent: Optional[str] = None):
+    """Log user actions for audit purposes without waiting for the write"""
+    if not audit_enabled(action):
+        return
+    row = build_log(user_id, action, target_type, target_id, details, ip_address, user_agent).model_dump(exclude={"id"})
+    if _audit_flusher_running:
+        _audit_queue.put_nowait(row)
+    else:
+        _write_audit_rows([row])
+
+def audit_flusher():
+    """Write queued audit entries, AUDIT_BUFFER_MAX at a time or every AUDIT_FLUSH_INTERVAL,
+    until the None sentinel arrives; runs in a worker thread started by lifespan"""
+    stopping = False
+    while not stopping:
+        # Sleep until there is something to write, then give the batch a bounded time to fill
+        row = _audit_queue.get()
+        if row is None:
+            break
+        batch = [row]
+        deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+        while len(batch) < AUDIT_BUFFER_MAX:
+            try:
+                row = _audit_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if row is None:
+                stopping = True
+                break
+            batch.append(row)
+        try:
+            _write_audit_rows(batch)
+        except Exception as e:
+            log.error("Failed to write %d audit entries: %r", len(batch), e)
+
+def drain_audit_queue():
+    """Write whatever is still queued once audit_flusher() has stopped"""
+    rows = []
+    while True:
+        try:
+            row = _audit_queue.get_nowait()
+        except queue.Empty:
+            break
+        if row is not None:
+            rows.append(row)
+    if rows:
+        _write_audit_rows(rows)
+
+# Audit entries older than AUDIT_TRAIL_RETENTION_DAYS are deleted once a day (0 keeps them all),
+# in batches so no single transaction holds the write lock for long
+AUDIT_TRAIL_RETENTION_DAYS = int(os.getenv("AUDIT_TRAIL_RETENTION_DAYS", "90"))
+AUDIT_TRAIL_CLEANUP_BATCH_SIZE = int(os.getenv("AUDIT_TRAIL_CLEANUP_BATCH_SIZE", "10000"))
+AUDIT_TRAIL_CLEANUP_INTERVAL = 24 * 60 * 60
+
+# SQLite is built without DELETE ... LIMIT, so each batch is picked by id
+_PURGE_AUDIT_BATCH = delete(AuditLog).where(AuditLog.id.in_(
+    select(AuditLog.id).where(AuditLog.timestamp < bindparam("cutoff")).limit(bindparam("batch_size"))
+))
+
+def purge_audit_logs() -> int:
+    """Delete audit entries past the retention period; returns how many went"""
+    if AUDIT_TRAIL_RETENTION_DAYS <= 0:
+        return 0
+    # AuditLog.timestamp is written in UTC, so the cutoff must be too
+    params = {"cutoff": datetime.utcnow() - timedelta(days=AUDIT_TRAIL_RETENTION_DAYS),
+              "batch_size": AUDIT_TRAIL_CLEANUP_BATCH_SIZE}
+    deleted = 0
+    with SessionLocal() as session:
+        while True:
+            count = session.exec(_PURGE_AUDIT_BATCH, params=params).rowcount
+            session.commit()
+            deleted += count
+            if count < AUDIT_TRAIL_CLEANUP_BATCH_SIZE:
+                return deleted
+
+async def audit_retention():
+    """Run purge_audit_logs() at startup and then once per AUDIT_TRAIL_CLEANUP_INTERVAL"""
+    while True:
+        try:
+            deleted = await asyncio.to_thread(purge_audit_logs)
+            if deleted:
+                log.info("Deleted %d audit entries older than %d days", deleted, AUDIT_TRAIL_RETENTION_DAYS)
+        except Exception as e:
+            log.error("Audit retention cleanup failed: %r", e)
+        await asyncio.sleep(AUDIT_TRAIL_CLEANUP_INTERVAL)
 
 # --- Security ---
 security = HTTPBearer()
 
+# Authenticated users by id, so most requests skip the DB lookup. Endpoints that change
+# a user row call invalidate_user(); anything missed is corrected within the TTL.
+_user_cache = TTLCache(maxsize=4096, ttl=30)
+_user_cache_lock = threading.Lock()  # TTLCache isn't thread-safe and sync endpoints run in a threadpool
+
+# Only what AuthedUser needs; the password hash and tag id stay in the database
+_AUTHED_USER_BY_ID = select(User.id, User.name, User.role, User.auth_level, User.is_active).where(User.id == bindparam("user_id"))
+
+def invalidate_user(user_id: int):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+# Verified claims by token digest, so a client repeating its bearer token skips the signature
+# check and JSON parsing. Entries keep the token's exp and are refused once it has passed.
+_token_cache = TTLCache(maxsize=10_000, ttl=30)
+_token_cache_lock = threading.Lock()
+
+def decode_token(token: str) -> Optional[TokenData]:
+    """Claims of a valid bearer token, or None if it is malformed, forged or expired"""
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+    if cached is not None:
+        token_data, exp = cached
+        return token_data if time.time() < exp else None
+    try:
+        payload = jwt.decode(token, PUBLIC_KEY, algorithms=[ALGORITHM])
+    except jwt.PyJWTError:
+        return None
+    username: str = payload.get("sub")
+    user_id: int = payload.get("user_id")
+    role: str = payload.get("role")
+    if username is None or user_id is None or role is None:
+        return None
+    token_data = TokenData(username=username, user_id=user_id, role=UserRole(role))
+    with _token_cache_lock:
+        _token_cache[key] = (token_data, payload.get("exp", float("inf")))
+    return token_data
+
+def _load_authed_user(user_id: int) -> Optional[AuthedUser]:
+    with SessionLocal() as session:
+        row = session.exec(_AUTHED_USER_BY_ID, params={"user_id": user_id}).first()
+    return AuthedUser(**row._asdict()) if row else None
+
 async def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        user_id: int = payload.get("user_id")
-        role: str = payload.get("role")
-        if username is None or user_id is None or role is None:
-            raise credentials_exception
-        token_data = TokenData(username=username, user_id=user_id, role=UserRole(role))
-    except jwt.PyJWTError:
+    token_data = decode_token(credentials.credentials)
+    if token_data is None:
         raise credentials_exception
     
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.id == token_data.user_id)).first()
+    with _user_cache_lock:
+        user = _user_cache.get(token_data.user_id)
     if user is None:
-        raise credentials_exception
+        # A cache miss is a DB round-trip; keep it off the event loop
+        user = await run_in_threadpool(_load_authed_user, token_data.user_id)
+        if user is None:
+            raise credentials_exception
+        with _user_cache_lock:
+            _user_cache[user.id] = user
     return user
 
-async def get_current_active_user(current_user: User = Depends(get_current_user)):
+async def get_current_active_user(current_user: AuthedUser = Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
+# Memoised so every route asking for the same level shares one dependency callable
+@lru_cache(maxsize=None)
 def require_auth_level(required_level: int):
     """Decorator to require specific authentication level"""
-    def dependency(current_user: User = Depends(get_current_active_user)):
+    def dependency(current_user: AuthedUser = Depends(get_current_active_user)):
         if current_user.auth_level < required_level:
             raise HTTPException(
                 status_code=403,
@@ -225,9 +640,10 @@ def require_auth_level(required_level: int):
         return current_user
     return dependency
 
+@lru_cache(maxsize=None)
 def require_role(required_role: UserRole):
     """Decorator to require specific role"""
-    def dependency(current_user: User = Depends(get_current_active_user)):
+    def dependency(current_user: AuthedUser = Depends(get_current_active_user)):
         if current_user.role != required_role and current_user.role != UserRole.ADMIN:
             raise HTTPException(
                 status_code=403,
@@ -238,70 +654,116 @@ def require_role(required_role: UserRole):
 
 
 # --- NFC and Database Globals ---
-_clf: Optional[nfc.ContactlessFrontend] = None
-_scan_thread: Optional[threading.Thread] = None
+# nfc, usb and usb1 are imported where the reader is first touched, so processes that
+# never open it (tests, health probes, reloads) don't pay for them
+_clf: Optional["nfc.ContactlessFrontend"] = None
+_scan_task: Optional[asyncio.Task] = None
 _stop_event = threading.Event()
-_clf_lock = threading.Lock()  # Prevent concurrent connect() calls
+# One-shot connect() requests from endpoints, executed by the scan thread: (on_connect, deadline, future)
+_nfc_jobs: "queue.Queue[tuple]" = queue.Queue()
 
 app = FastAPI()  # will be replaced by app = FastAPI(lifespan=lifespan) below
 
-try:
-    import usb1
-except Exception:
-    usb1 = None
-
-import usb.core
-import usb.util
+@dataclass
+class ReaderState:
+    """Reader state shared between the scan thread and the app, swapped by attribute assignment"""
+    last_uid: bytes = b""  # raw identifier of the last tag handled, to skip repeat polls of the same card
+    device: object = None  # nfc.clf.acr122.Device, for LED/buzzer control
+    path: str = "usb"  # nfcpy path, narrowed to usb:bus:address once the reader has been opened
 
-device = None
-LASTUUID="example"
-LASTID = "example"
+STATE = ReaderState()
 ACR122_VID = 0x072F
 ACR122_PID = 0x2200
 
+# libusb context and ACR122 device kept across resets so we only enumerate the bus once
+_usb_ctx = None
+_acr122_usb_device = None
+
+def _open_acr122_usb1():
+    # Opens the cached usb1 device; on the first call (or after the cache was invalidated
+    # because the device went away) libusb1 finds and opens it by VID/PID instead of us
+    # walking the whole device list. Returns None if no reader is attached.
+    global _usb_ctx, _acr122_usb_device
+    if _acr122_usb_device is not None:
+        return _acr122_usb_device.open()
+    if _usb_ctx is None:
+        import usb1
+        _usb_ctx = usb1.USBContext()
+    handle = _usb_ctx.openByVendorIDAndProductID(ACR122_VID, ACR122_PID, skip_on_error=True)
+    if handle is not None:
+        _acr122_usb_device = handle.getDevice()
+    return handle
+
+def _wait_for_acr122(timeout: float, interval: float = 0.05) -> bool:
+    # Poll until the reader is back on the bus after a reset instead of sleeping
+    # for the worst case; gives up after `timeout` seconds.
+    import usb.core
+    deadline = time.monotonic() + timeout
+    while True:
+        time.sleep(interval)
+        try:
+            if usb.core.find(idVendor=ACR122_VID, idProduct=ACR122_PID) is not None:
+                return True
+        except Exception:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+
 def reset_acr122(timeout: float = 0.6) -> bool:
     # Try to reset ACR122 using usb1 (libusb1) if available, then fallback to PyUSB.
     # Returns True if any reset attempt succeeded (or device not present but no exception),
     # False if all attempts failed.
     # 1) Try usb1 (libusb1) reset — preferred, because nfcpy uses usb1/libusb1
+    global _acr122_usb_device
+    # A reset re-enumerates the reader under a new address
+    STATE.path = "usb"
+    try:
+        import usb1
+    except Exception:
+        usb1 = None
     if usb1 is not None:
-        try:
-            ctx = usb1.USBContext()
-            for dev in ctx.getDeviceList(skip_on_error=True):
+        # Two attempts: the cached device first, then a fresh VID/PID lookup if it was stale
+        for _ in range(2):
+            try:
+                handle = _open_acr122_usb1()
+                if handle is None:
+                    break
+            except usb1.USBErrorNoDevice:
+                # Device was unplugged/re-enumerated since we cached it
+                _acr122_usb_device = None
+                continue
+            except Exception as e:
+                log.warning("usb1 context/setup error: %r", e)
+                break
+            try:
+                # DeviceHandle.resetDevice() - resets USB device
+                handle.resetDevice()
+                # wait (at most `timeout`) for the OS to re-enumerate
+                _wait_for_acr122(timeout)
+                log.info("usb1: device reset successfully.")
+                return True
+            except Exception as e:
+                # A failed reset usually means the device re-enumerated; look it up again next time
+                _acr122_usb_device = None
+                log.warning("usb1: reset failed: %r", e)
+            finally:
                 try:
-                    if dev.getVendorID() == ACR122_VID and dev.getProductID() == ACR122_PID:
-                        handle = dev.open()
-                        try:
-                            # DeviceHandle.resetDevice() - resets USB device
-                            handle.resetDevice()
-                            # small pause to let OS re-enumerate
-                            time.sleep(timeout)
-                            handle.close()
-                            print("usb1: device reset successfully.")
-                            ctx.exit()
-                            return True
-                        except Exception as e:
-                            try:
-                                handle.close()
-                            except Exception:
-                                pass
-                            print("usb1: reset failed:", repr(e))
+                    handle.close()
                 except Exception:
-                    # ignore single-device errors, continue scanning
                     pass
-            ctx.exit()
-        except Exception as e:
-            print("usb1 context/setup error:", repr(e))
+            break
 
     # 2) Fallback to PyUSB reset (works in many cases)
+    import usb.core
+    import usb.util
     try:
         dev = usb.core.find(idVendor=ACR122_VID, idProduct=ACR122_PID)
     except Exception as e:
-        print("pyusb find error:", repr(e))
+        log.warning("pyusb find error: %r", e)
         dev = None
 
     if dev is None:
-        print("USB device (ACR122) not found for reset (pyusb).")
+        log.warning("USB device (ACR122) not found for reset (pyusb).")
     else:
         try:
             # dispose resources first
@@ -310,84 +772,87 @@ def reset_acr122(timeout: float = 0.6) -> bool:
             except Exception:
                 pass
             dev.reset()
-            time.sleep(timeout)
+            _wait_for_acr122(timeout)
             return True
         except Exception as e:
-            print("pyusb: USB rese failed:", repr(e))
+            log.warning("pyusb: USB reset failed: %r", e)
 
     return False
 
-def format_tag_id(tag):
+def open_reader():
+    """Open the reader by its last known usb:bus:address, so nfcpy tries one device
+    instead of probing everything on the bus; falls back to a full search."""
+    import nfc
     try:
-        return tag.identifier.hex()
+        clf = nfc.ContactlessFrontend(STATE.path)
     except Exception:
-        try:
-            return binascii.hexlify(tag.identifier).decode()
-        except Exception:
-            return str(tag.identifier)
-
-
-def handle_tag(tag, request: Optional[Request] = None):
-    # Called when a tag is connected. Checks TextRecord content and processes check-in/out
-    global LASTID, device, LASTUUID
-    tid = format_tag_id(tag)    
+        if STATE.path == "usb":
+            raise
+        STATE.path = "usb"  # replugged or re-enumerated since we cached it
+        clf = nfc.ContactlessFrontend(STATE.path)
+    STATE.path = clf.device.path
+    return clf
+
+def first_text(records) -> Optional[str]:
+    # A registered tag carries exactly one TextRecord; stop at the first one
+    return next((r.text for r in records if isinstance(r, TextRecord)), None)
+
+# Tags handled in the last two seconds. last_uid only covers a card resting on the reader;
+# this also drops re-reads when two cards are swapped back and forth or a card bounces in and
+# out of the field with another one in between. Only the scan thread touches it.
+_recent_uids = TTLCache(maxsize=64, ttl=2.0)
+
+def handle_tag(uid: bytes, records: Optional[list], request: Optional[Request] = None,
+               session: Optional[Session] = None):
+    # Processes a tag captured by scan_loop, once connect() has returned.
+    # `records` is None when the tag is not NDEF-compatible; `session` is the scan thread's own.
+    if uid == STATE.last_uid or uid in _recent_uids:
+        # Same card still on the reader or just read: nothing to parse, nothing to write
+        return
     try:
-        if LASTID != tid:
-            # if device: #This shit doesn't work at the moment because of AssertionError and shit.
-            #     try:
-            #         device.turn_on_led_and_buzzer()
-            #     except Exception as e:
-            #         print("LED/buzzer activation failed:", repr(e))
-            if getattr(tag, "ndef", None):
-                if tag.ndef:
-                    found_textrecord = False
-                    for record in tag.ndef.records:
-                        if isinstance(record, TextRecord):
-                            found_textrecord = True
-                            text_content = record.text                        
-                            # Process check-in/out logic
-                            process_nfc_scan(text_content, request)
-                    if not found_textrecord:
-                        print("No TextRecord found on tag")
-                else:
-                    print("Tag has no NDEF records")
+        # if STATE.device: #This shit doesn't work at the moment because of AssertionError and shit.
+        #     try:
+        #         STATE.device.turn_on_led_and_buzzer()
+        #     except Exception as e:
+        #         print("LED/buzzer activation failed:", repr(e))
+        if records is not None:
+            text_content = first_text(records)
+            if text_content is not None:
+                # Process check-in/out logic
+                process_nfc_scan(text_content, request, session)
             else:
-                print("Tag is not NDEF-compatible")
-            LASTID = tid
-            print("New tag detected")
+                log.info("No TextRecord found on tag")
+        else:
+            log.info("Tag is not NDEF-compatible")
+        STATE.last_uid = uid
+        _recent_uids[uid] = True
+        log.debug("New tag detected: %s", uid.hex())
     except Exception as e:
-        print("Error reading NDEF:", repr(e))
+        log.error("Error processing tag: %r", e)
 
-def process_nfc_scan(tag_content: str, request: Optional[Request] = None):
-    """Process NFC scan for check-in/out with duty teacher association"""
+def process_nfc_scan(tag_content: str, request: Optional[Request] = None,
+                     scan_session: Optional[Session] = None):
+    """Process NFC scan for check-in/out with duty teacher association.
+    Uses scan_session when given (left open for the caller), otherwise a fresh Session."""
     try:
-        with Session(engine) as session:
-            # Find the user by tag content
-            user = session.exec(select(Student).where(Student.tid == tag_content)).first()
+        with (nullcontext(scan_session) if scan_session is not None else SessionLocal()) as session:
+            # One clock read for both the stored lastscan and the notification timestamp
+            now_ts = time.time()
+            # Find the user by tag content and flip their in_school status
+            user = session.exec(_FLIP_STUDENT_STATUS, params={"tag": tag_content, "scan_time": int(now_ts)}).first()
             
             # Check if user was found
             if not user:
                 return
+            new_status = user.in_school
+            old_status = not new_status
             
             # Get current duty teacher
-            duty_teacher = session.exec(select(User).where(User.assigned_duty == True)).first()
-            duty_teacher_name = duty_teacher.name if duty_teacher else "No duty teacher"
-            duty_teacher_id = duty_teacher.id if duty_teacher else None
-            
-            # Determine scan type and flip in_school status
-            scan_time = int(time.time())
-            old_status = user.in_school
-            new_status = not old_status  # Flip the status
-            
-            # Update user record
-            user.in_school = new_status
-            user.lastscan = scan_time
-            session.commit()
+            duty_teacher_id, duty_teacher_name = get_duty_teacher(session) or (None, "No duty teacher")
             
             # Log the scan with duty teacher association
             scan_type = "check_in" if new_status else "check_out"
-            log_action(
-                session,
+            logs = [build_log(
                 user.id,
                 f"{scan_type}_with_duty_teacher",
                 "user",
@@ -395,12 +860,11 @@ def process_nfc_scan(tag_content: str, request: Optional[Request] = None):
                 f"User {user.name} {scan_type} - Duty teacher: {duty_teacher_name}",
                 request.client.host if request else None,
                 request.headers.get("user-agent") if request else None
-            )
+            )]
             
             # Also log from duty teacher's perspective if available
             if duty_teacher_id:
-                log_action(
-                    session,
+                logs.append(build_log(
                     duty_teacher_id,
                     f"recorded_{scan_type}",
                     "user",
@@ -408,9 +872,18 @@ def process_nfc_scan(tag_content: str, request: Optional[Request] = None):
                     f"Recorded {user.name} {scan_type} - Teacher on duty",
                     request.client.host if request else None,
                     request.headers.get("user-agent") if request else None
-                )
+                ))
+            
+            # Status flip and audit entries go out in one transaction; the entries as one
+            # Core executemany rather than ORM instances flushed through the unit of work
+            rows = [entry.model_dump(exclude={"id"}) for entry in logs if audit_enabled(entry.action)]
+            if rows:
+                session.exec(insert(AuditLog), params=rows)
+            session.commit()
+            invalidate_check_in_status()
             
-            print(f"Processed {scan_type} for {user.name} (was {old_status}, now {new_status}) - Duty teacher: {duty_teacher_name}")
+            log.info("Processed %s for %s (was %s, now %s) - Duty teacher: %s",
+                     scan_type, user.name, old_status, new_status, duty_teacher_name)
             
             # Queue WebSocket notification for thread-safe handling
             notification_message = {
@@ -420,157 +893,227 @@ def process_nfc_scan(tag_content: str, request: Optional[Request] = None):
                 "student_id": user.id,
                 "old_status": old_status,
                 "new_status": new_status,
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": datetime.fromtimestamp(now_ts),  # orjson writes datetimes as ISO 8601 itself
                 "duty_teacher": duty_teacher_name
             }
             
             # Queue the message to be processed by the main event loop
             manager.queue_message(notification_message)
-            print(f"Queued WebSocket notification for {user.name} {scan_type}")
+            log.debug("Queued WebSocket notification for %s %s", user.name, scan_type)
             
     except Exception as e:
-        print(f"Error processing NFC scan: {repr(e)}")
+        log.error("Error processing NFC scan: %r", e)
+        if scan_session is not None:
+            scan_session.rollback()  # keep the scan thread's session usable for the next tap
         # Log the error for debugging
         try:
-            with Session(engine) as session:
-                log_action(
-                    session,
-                    0,  # System user ID for errors
-                    "nfc_scan_error",
-                    "system",
-                    tag_content,
-                    f"NFC scan processing failed: {repr(e)}",
-                    request.client.host if request else None,
-                    request.headers.get("user-agent") if request else None
-                )
+            enqueue_audit(
+                0,  # System user ID for errors
+                "nfc_scan_error",
+                "system",
+                tag_content,
+                f"NFC scan processing failed: {repr(e)}",
+                request.client.host if request else None,
+                request.headers.get("user-agent") if request else None
+            )
         except Exception as log_error:
-            print(f"Failed to log error: {repr(log_error)}")
+            log.error("Failed to log error: %r", log_error)
 
 
-def scan_loop(clf: nfc.ContactlessFrontend, stop_event: threading.Event, poll_period: float = 2.0):
-    """Continuously poll for NFC tags. Uses _clf_lock to prevent concurrent access."""
-    print("NFC scan loop started.")    
-    while not stop_event.is_set():
-        tag_found = False
+def _run_nfc_job(clf: "nfc.ContactlessFrontend", on_connect, deadline: float, fut: concurrent.futures.Future):
+    """Run a queued endpoint request on the scan thread"""
+    if not fut.set_running_or_notify_cancel():
+        return  # the request gave up while it was queued
 
-        def on_connect(tag):
-            nonlocal tag_found
-            tag_found = True
-            try:
-                handle_tag(tag)
-            except Exception as e:
-                print("Error in on_connect handler:", repr(e))
-            return False  # disconnect immediately after processing
+    # Locals keep the per-tick check to two C calls and a compare
+    is_set, monotonic = _stop_event.is_set, time.monotonic
 
-        start = time.time()
+    def terminate():
+        return is_set() or monotonic() >= deadline
 
-        def terminate():
-            return stop_event.is_set() or (time.time() - start) > poll_period
+    try:
+        clf.connect(rdwr={"on-connect": on_connect}, terminate=terminate)
+    except Exception as e:
+        fut.set_exception(e)
+    else:
+        fut.set_result(None)
 
-        acquired = _clf_lock.acquire(timeout=5.0)
-        if not acquired:
-            print("scan_loop: unable to acquire reader lock, skipping this cycle")
-            time.sleep(0.1)
-            continue
 
-        try:
-            try:
-                clf.connect(rdwr={"on-connect": on_connect}, terminate=terminate)
-            except Exception as e:
-                print("connect() error in scan_loop:", repr(e))
-        finally:
-            _clf_lock.release()
+async def run_nfc_job(on_connect, timeout: float):
+    """Hand a one-shot connect() to the scan thread and wait for it without holding a worker thread.
 
+    Raises asyncio.TimeoutError if the reader never got to the request (busy or reopening).
+    """
+    fut = concurrent.futures.Future()
+    _nfc_jobs.put((on_connect, time.monotonic() + timeout, fut))
+    # The deadline bounds the connect() itself; the extra slack covers time spent queued
+    await asyncio.wait_for(asyncio.wrap_future(fut), timeout + 5.0)
+
+
+# Pauses in scan_loop so neither a failing reader nor a card left on it turns into a busy loop
+SCAN_ERROR_BACKOFF = 0.5  # after connect() raised
+SCAN_REPEAT_PAUSE = 0.2  # after connect() only saw a tag that was just handled
+
+def scan_loop(clf: "nfc.ContactlessFrontend", stop_event: threading.Event):
+    """Continuously poll for NFC tags, serving queued endpoint requests between polls.
+    This thread is the only caller of clf.connect(), so the reader needs no lock."""
+    log.info("NFC scan loop started.")
+    # terminate() is called on every nfcpy polling tick; bind its lookups once
+    is_set, jobs_empty = stop_event.is_set, _nfc_jobs.empty
+
+    def terminate():
+        # connect() stays up until a tag is read, an endpoint queues a request or we shut down
+        return is_set() or not jobs_empty()
+
+    # One session for the life of the loop instead of one per tap
+    with SessionLocal() as scan_session:
+        while not stop_event.is_set():
+            captured = None
+            repeat = False
+
+            def on_connect(tag):
+                # Runs while the card is in the field: only copy out the tag id and
+                # records, everything else happens after connect() returns
+                nonlocal captured, repeat
+                try:
+                    # nfcpy identifiers are bytes; compare them raw, hex only for logging
+                    uid = tag.identifier
+                    if uid != STATE.last_uid and uid not in _recent_uids:
+                        ndef = getattr(tag, "ndef", None)
+                        captured = (uid, list(ndef.records) if ndef else None)
+                    else:
+                        repeat = True
+                except Exception as e:
+                    log.warning("Error reading NDEF: %r", e)
+                return False  # disconnect immediately after reading
 
-        time.sleep(0.1)
+            try:
+                job = _nfc_jobs.get_nowait()
+            except queue.Empty:
+                job = None
+            if job is not None:
+                _run_nfc_job(clf, *job)
+            else:
+                try:
+                    clf.connect(rdwr={"on-connect": on_connect}, terminate=terminate)
+                except Exception as e:
+                    log.warning("connect() error in scan_loop: %r", e)
+                    # An unplugged or failing reader raises straight away; don't spin on it
+                    stop_event.wait(SCAN_ERROR_BACKOFF)
+                    continue
 
-    print("NFC scan loop stopped.")
+            if captured is not None:
+                handle_tag(*captured, session=scan_session)
+                # Drop this tap's rows from the identity map; the session itself is reused
+                scan_session.expire_all()
+            elif repeat:
+                # A card resting on the reader is found again at once; don't re-activate it in a tight loop
+                stop_event.wait(SCAN_REPEAT_PAUSE)
+            # Otherwise no sleep: connect() re-arms immediately so a new tap is picked up on the next poll
+
+    log.info("NFC scan loop stopped.")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global _clf, _scan_thread, _stop_event, device
+    global _clf, _scan_task, _stop_event, _audit_flusher_running
+    import nfc
+    if os.getenv("AUTO_CREATE_TABLES", "1") == "1":
+        init_db()
     _stop_event.clear()
-    reset_acr122()
+    # Open first and only pay for a USB reset (and its settle time) if that fails
     try:
-        _clf = nfc.ContactlessFrontend('usb')
-        print("NFC reader opened successfully at startup.")
+        _clf = open_reader()
+        log.info("NFC reader opened successfully at startup.")
     except Exception as e:
-        print("Unable to open NFC reader at startup:", repr(e))
-        _clf = None
-    if device is None:
+        log.warning("Unable to open NFC reader at startup, resetting USB: %r", e)
+        reset_acr122()
+        try:
+            _clf = open_reader()
+            log.info("NFC reader opened successfully after reset.")
+        except Exception as e:
+            log.warning("Unable to open NFC reader at startup: %r", e)
+            _clf = None
+    if STATE.device is None:
         try:
-            device = nfc.clf.acr122.Device(_clf)
-            print("Device instance created successfully.")
+            STATE.device = nfc.clf.acr122.Device(_clf)
+            log.info("Device instance created successfully.")
         except AssertionError as e:
-            print("Failed to create Device instance:", repr(e))
-            device = None
+            log.warning("Failed to create Device instance: %r", e)
+            STATE.device = None
     # Background scanning thread starter
     def starter():
         global _clf
         while not _stop_event.is_set():
             if _clf is None:
-                # Reset the USB device before attempting to open (helps without manual replug)
-                reset_acr122()
                 try:
-                    _clf = nfc.ContactlessFrontend('usb')
-                    print("NFC reader opened successfully.")
+                    _clf = open_reader()
+                    log.info("NFC reader opened successfully.")
                 except Exception as e:
-                    print("Waiting for NFC reader... (open failed):", repr(e))
-                    time.sleep(3)
+                    log.info("Waiting for NFC reader... (open failed): %r", e)
+                    # Reset the USB device before the next attempt (helps without manual replug)
+                    reset_acr122()
+                    # Waits on the stop event so shutdown doesn't sit out the retry delay
+                    if _stop_event.wait(3.0):
+                        return
                     continue
             try:
-                scan_loop(_clf, _stop_event, poll_period=2.0)
+                scan_loop(_clf, _stop_event)
             except Exception as e:
-                print("scan_loop crashed:", repr(e))
+                log.error("scan_loop crashed: %r", e)
                 try:
                     if _clf:
                         _clf.close()
                 except Exception:
                     pass
                 _clf = None
-                time.sleep(1)
+                _stop_event.wait(1.0)
 
-    _scan_thread = threading.Thread(target=starter, daemon=True, name="nfc-scan-thread")
-    _scan_thread.start()
+    manager.start()  # before the scan thread can queue notifications
+    # The blocking reader loop runs in a worker thread owned by an event-loop task
+    _scan_task = asyncio.create_task(asyncio.to_thread(starter), name="nfc-scan")
 
     # Start WebSocket message processor task
-    async def process_messages_task():
-        while True:
-            try:
-                await manager.process_pending_messages()
-                await asyncio.sleep(0.1)  # Process messages every 100ms
-            except Exception as e:
-                print(f"Error processing WebSocket messages: {e}")
-                await asyncio.sleep(1)
+    message_processor = asyncio.create_task(manager.process_messages())
 
-    message_processor = asyncio.create_task(process_messages_task())
+    audit_task = asyncio.create_task(asyncio.to_thread(audit_flusher), name="audit-flusher")
+    _audit_flusher_running = True
+    retention_task = asyncio.create_task(audit_retention(), name="audit-retention")
 
     try:
         yield
     finally:
-        print("Shutting down NFC scanner .....")
+        log.info("Shutting down NFC scanner .....")
         _stop_event.set()
-        if _scan_thread and _scan_thread.is_alive():
-            _scan_thread.join(timeout=5.0)
+        if _scan_task:
+            # Cancelling cannot interrupt the thread; terminate() sees _stop_event within one poll
+            await asyncio.wait({_scan_task}, timeout=5.0)
+            _scan_task.cancel()
+            await asyncio.gather(_scan_task, return_exceptions=True)
         
-        # Cancel message processor
+        # Cancel message processor and the retention loop
         message_processor.cancel()
-        try:
-            await message_processor
-        except asyncio.CancelledError:
-            pass
+        retention_task.cancel()
+        await asyncio.gather(message_processor, retention_task, return_exceptions=True)
+        
+        # The flusher writes everything queued ahead of the sentinel; entries that land behind
+        # it are written once it has stopped, and from then on enqueue_audit() writes directly
+        _audit_queue.put(None)
+        await audit_task
+        _audit_flusher_running = False
+        await asyncio.to_thread(drain_audit_queue)
         
         # try:
         #     if _clf:
         #         _clf.close()
         # except Exception as e:
         #     print("Error closing clf:", repr(e))
-        print("Shutdown complete.")
+        log.info("Shutdown complete.")
 
 
 # Assign the lifespan handler (replace previous FastAPI instance)
-app = FastAPI(lifespan=lifespan)
+# orjson encodes every response body; endpoints that already pass plain rows return ORJSONResponse directly
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -585,246 +1128,236 @@ def root():
 
 
 @app.post("/register", response_model=Token)
-async def register_user(request: Request, user: UserCreate):
+def register_user(request: Request, user: UserCreate, session: Session = Depends(get_session)):
     """Temporary registration endpoint - DELETE AFTER CREATING ADMIN USER"""
-    with Session(engine) as session:
-        # Check if user already exists
-        db_user = session.exec(select(User).where(User.name == user.username)).first()
-        if db_user:
-            raise HTTPException(status_code=400, detail="Username already registered")
-        
-        # Create new user with role-based auth level
-        auth_level = 0  # Default student
-        if user.role == UserRole.TEACHER:
-            auth_level = 1
-        elif user.role == UserRole.IT_STAFF:
-            auth_level = 2
-        elif user.role == UserRole.ADMIN:
-            auth_level = 3
-        
-        hashed_password = get_password_hash(user.password)
-        db_user = User(
-            name=user.username,
-            hashed_password=hashed_password,
-            role=user.role,
-            auth_level=auth_level,
-            is_active=True,
-            assigned_duty=user.assigned_duty
-        )
-        session.add(db_user)
-        session.commit()
-        session.refresh(db_user)
-        
-        # Create access token with user info
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={
-                "sub": db_user.name, 
-                "user_id": db_user.id, 
-                "role": db_user.role.value
-            }, 
-            expires_delta=access_token_expires
-        )
-        
-        # Log registration
-        log_action(
-            session, 
-            db_user.id, 
-            "user_registered", 
-            "user", 
-            str(db_user.id),
-            f"New user registered with role {user.role}",
-            request.client.host,
-            request.headers.get("user-agent")
-        )
-        
-        return {
-            "access_token": access_token, 
-            "token_type": "bearer",
-            "user_role": db_user.role,
-            "user_id": db_user.id
-        }
+    # Check if user already exists
+    db_user = session.exec(select(User).where(User.name == user.username)).first()
+    if db_user:
+        raise HTTPException(status_code=400, detail="Username already registered")
+    
+    # Create new user with role-based auth level
+    auth_level = ROLE_AUTH_LEVEL[user.role]
+    
+    # Argon2 takes a noticeable fraction of a second; as a plain def this whole endpoint,
+    # lookups and commit included, runs in the threadpool rather than on the event loop
+    hashed_password = get_password_hash(user.password)
+    cleared = []
+    if user.assigned_duty:
+        # Same as assign_duty: ix_user_on_duty allows one teacher on duty, so hand it over
+        cleared = session.exec(
+            update(User).where(User.assigned_duty == True).values(assigned_duty=False).returning(User.id)
+        ).scalars().all()
+    db_user = User(
+        name=user.username,
+        hashed_password=hashed_password,
+        role=user.role,
+        auth_level=auth_level,
+        is_active=True,
+        assigned_duty=user.assigned_duty
+    )
+    session.add(db_user)
+    session.flush()  # assigns db_user.id for the token and the audit entry
+    
+    # Create access token with user info
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data={
+            "sub": db_user.name, 
+            "user_id": db_user.id, 
+            "role": db_user.role.value
+        }, 
+        expires_delta=access_token_expires
+    )
+    
+    # Log registration
+    add_log(
+        session,
+        db_user.id, 
+        "user_registered", 
+        "user", 
+        str(db_user.id),
+        f"New user registered with role {user.role}",
+        request.client.host,
+        request.headers.get("user-agent")
+    )
+    session.commit()
+    if user.assigned_duty:
+        for user_id in cleared:
+            invalidate_user(user_id)
+        invalidate_duty_teacher()
+    
+    return {
+        "access_token": access_token, 
+        "token_type": "bearer",
+        "user_role": db_user.role,
+        "user_id": db_user.id
+    }
 
 @app.post("/login", response_model=Token)
-async def login_for_access_token(request: Request, form_data: UserLogin):
-    with Session(engine) as session:
-        user = authenticate_user(session, form_data.username, form_data.password)
-        if not user:
-            raise HTTPException(
-                status_code=401,
-                detail="Incorrect username or password",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={
-                "sub": user.name, 
-                "user_id": user.id, 
-                "role": user.role.value
-            }, 
-            expires_delta=access_token_expires
+def login_for_access_token(request: Request, form_data: UserLogin, session: Session = Depends(get_session)):
+    # Plain def: the Argon2 verify and the audit commit both run in the threadpool
+    user = authenticate_user(session, form_data.username, form_data.password)
+    if not user:
+        raise HTTPException(
+            status_code=401,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
         )
-        
-        # Log login
-        log_action(
-            session, 
-            user.id, 
-            "user_login", 
-            "user", 
-            str(user.id),
-            f"User logged in from {request.client.host}",
-            request.client.host,
-            request.headers.get("user-agent")
-        )
-        
-        return {
-            "access_token": access_token, 
-            "token_type": "bearer",
-            "user_role": user.role,
-            "user_id": user.id
-        }
+    
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data={
+            "sub": user.name, 
+            "user_id": user.id, 
+            "role": user.role.value
+        }, 
+        expires_delta=access_token_expires
+    )
+    
+    # Log login
+    add_log(
+        session,
+        user.id, 
+        "user_login", 
+        "user", 
+        str(user.id),
+        f"User logged in from {request.client.host}",
+        request.client.host,
+        request.headers.get("user-agent")
+    )
+    session.commit()
+    
+    return {
+        "access_token": access_token, 
+        "token_type": "bearer",
+        "user_role": user.role,
+        "user_id": user.id
+    }
 
 
 @app.get("/status")
-def status():
+async def status():
     return {"reader_connected": bool(_clf is not None)}
 
 @app.get("/system/scan-test")
-async def test_scan(current_user: User = Depends(require_auth_level(1))):
+async def test_scan(current_user: AuthedUser = Depends(require_auth_level(1))):
     """Test endpoint to verify NFC scanning is working"""
     global _clf
     if _clf is None:
         raise HTTPException(status_code=503, detail="NFC reader not available")
     
-    def test_scan_function():
-        scan_result = {"detected": False, "content": None}
-        
-        def on_connect(tag):
-            nonlocal scan_result
-            try:
-                if getattr(tag, "ndef", None):
-                    if tag.ndef:
-                        for record in tag.ndef.records:
-                            if isinstance(record, TextRecord):
-                                scan_result["detected"] = True
-                                scan_result["content"] = record.text
-                                print(f"Test scan detected: {record.text}")
-                                break
-                return False
-            except Exception as e:
-                print(f"Test scan error: {repr(e)}")
-                return False
-
-        start = time.time()
-
-        def terminate():
-            return (time.time() - start) > 5.0  # 5 second timeout for test
-
-        acquired = _clf_lock.acquire(timeout=0.5)
-        if not acquired:
-            return {"error": "reader busy"}
-
+    scan_result = {"detected": False, "content": None}
+    
+    def on_connect(tag):
         try:
-            try:
-                _clf.connect(rdwr={"on-connect": on_connect}, terminate=terminate)
-            except Exception as e:
-                return {"error": f"connect error: {repr(e)}"}
-        finally:
-            _clf_lock.release()
+            ndef = getattr(tag, "ndef", None)
+            text_content = first_text(ndef.records) if ndef else None
+            if text_content is not None:
+                scan_result["detected"] = True
+                scan_result["content"] = text_content
+                log.info("Test scan detected: %s", text_content)
+            return False
+        except Exception as e:
+            log.warning("Test scan error: %r", e)
+            return False
 
-        return scan_result
+    try:
+        await run_nfc_job(on_connect, 5.0)  # 5 second timeout for test
+    except asyncio.TimeoutError:
+        return {"error": "reader busy"}
+    except Exception as e:
+        return {"error": f"connect error: {repr(e)}"}
 
-    result = await run_in_threadpool(test_scan_function)
-    return result
+    return scan_result
 
 
 # --- Teacher Level 1 Endpoints ---
 @app.get("/teacher/current-duty")
-async def get_current_duty(current_user: User = Depends(require_auth_level(1))):
+def get_current_duty(current_user: AuthedUser = Depends(require_auth_level(1)), session: Session = Depends(get_session)):
     """Get teacher currently assigned to daily duty"""
-    with Session(engine) as session:
-        duty_teacher = session.exec(select(User).where(User.assigned_duty == True)).first()
-        if duty_teacher:
-            return {
-                "teacher_name": duty_teacher.name,
-                "teacher_id": duty_teacher.id
-            }
-        return {"message": "No teacher currently on duty"}
+    duty_teacher = get_duty_teacher(session)
+    if duty_teacher:
+        return {
+            "teacher_name": duty_teacher[1],
+            "teacher_id": duty_teacher[0]
+        }
+    return {"message": "No teacher currently on duty"}
 
 @app.post("/teacher/assign-duty/{teacher_id}")
-async def assign_duty(teacher_id: int, current_user: User = Depends(require_auth_level(1))):
+def assign_duty(teacher_id: int, current_user: AuthedUser = Depends(require_auth_level(1)), session: Session = Depends(get_session)):
     """Assign a teacher to daily duty"""
-    with Session(engine) as session:
-        # Remove current duty assignment
-        duty_users = session.exec(select(User).where(User.assigned_duty == True)).all()
-        for user in duty_users:
-            user.assigned_duty = False
-        
-        # Assign new duty
-        teacher = session.exec(select(User).where(User.id == teacher_id)).first()
-        if not teacher:
-            raise HTTPException(status_code=404, detail="Teacher not found")
-        
-        teacher.assigned_duty = True
-        session.commit()
-        
-        # Log assignment
-        log_action(
-            session,
-            current_user.id,
-            "duty_assigned",
-            "user",
-            str(teacher_id),
-            f"Assigned duty to {teacher.name}",
-            None,
-            None
-        )
-        
-        return {"message": f"Duty assigned to {teacher.name}"}
+    # Look up the new teacher first so a bad id leaves the current assignment alone
+    teacher_name = session.exec(select(User.name).where(User.id == teacher_id)).first()
+    if teacher_name is None:
+        raise HTTPException(status_code=404, detail="Teacher not found")
+    
+    # Remove current duty assignment before setting the new one, in this order:
+    # ix_user_on_duty rejects a second assigned_duty row at any point in the transaction
+    cleared = session.exec(
+        update(User).where(User.assigned_duty == True).values(assigned_duty=False).returning(User.id)
+    ).scalars().all()
+    session.exec(update(User).where(User.id == teacher_id).values(assigned_duty=True))
+    
+    # Log assignment
+    add_log(
+        session,
+        current_user.id,
+        "duty_assigned",
+        "user",
+        str(teacher_id),
+        f"Assigned duty to {teacher_name}",
+        None,
+        None
+    )
+    session.commit()
+    for user_id in (*cleared, teacher_id):
+        invalidate_user(user_id)
+    invalidate_duty_teacher()
+    
+    return {"message": f"Duty assigned to {teacher_name}"}
 
 # Consolidated student endpoint - teachers use /it/students with auth level 1
 # IT staff use /it/students with auth level 2
 
 @app.post("/teacher/students")
-async def add_student(request: Request, student_data: StudentCreate, current_user: User = Depends(require_auth_level(1))):
+def add_student(request: Request, student_data: StudentCreate, current_user: AuthedUser = Depends(require_auth_level(1)), session: Session = Depends(get_session)):
     """Add a new student (teacher and above)"""
-    with Session(engine) as session:
-        # Check if student already exists
-        existing_student = session.exec(select(Student).where(Student.name == student_data.name)).first()
-        if existing_student:
-            raise HTTPException(status_code=400, detail="Student with this name already exists")
-        
-        # Create new student
-        new_student = Student(
-            name=student_data.name,
-            tid="",  # Will be set when tag is registered
-            lastscan=int(time.time()),
-            in_school=False,
-            schoolClass=student_data.class_name
-        )
-        session.add(new_student)
-        session.commit()
-        session.refresh(new_student)
-        
-        # Log student creation
-        log_action(
-            session,
-            current_user.id,
-            "student_created",
-            "student",
-            str(new_student.id),
-            f"Created new student {new_student.name} in class {student_data.class_name}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
-        
-        return {"message": "Student created successfully", "student_id": new_student.id}
+    # Check if student already exists
+    existing_student = session.exec(select(Student).where(Student.name == student_data.name)).first()
+    if existing_student:
+        raise HTTPException(status_code=400, detail="Student with this name already exists")
+    
+    # Create new student
+    new_student = Student(
+        name=student_data.name,
+        tid="",  # Will be set when tag is registered
+        lastscan=int(time.time()),
+        in_school=False,
+        schoolClass=student_data.class_name
+    )
+    session.add(new_student)
+    session.flush()  # assigns new_student.id for the audit entry
+    
+    # Log student creation
+    add_log(
+        session,
+        current_user.id,
+        "student_created",
+        "student",
+        str(new_student.id),
+        f"Created new student {new_student.name} in class {student_data.class_name}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
+    session.commit()
+    invalidate_check_in_status()
+    
+    return {"message": "Student created successfully", "student_id": new_student.id}
 
 
 
 @app.post("/teacher/register-tag")
-async def register_student_tag(request: Request, student_data: dict, current_user: User = Depends(require_auth_level(1))):
+async def register_student_tag(request: Request, student_data: dict, current_user: AuthedUser = Depends(require_auth_level(1))):
     global _clf
     student_id = student_data.get("student_id")
     student_name = student_data.get("student_name")
@@ -840,12 +1373,10 @@ async def register_student_tag(request: Request, student_data: dict, current_use
                 student.image = payload.get("image")
             old_tid = student.tid
             student.tid = tid_str
-            session.commit()
-            session.refresh(student)
             return student, old_tid
     if _clf is None:
         raise HTTPException(status_code=503, detail="NFC reader not available")
-    def register_tag():
+    async def register_tag():
         written = False
         message = None
         tag_uuid = None
@@ -853,417 +1384,419 @@ async def register_student_tag(request: Request, student_data: dict, current_use
             nonlocal written, message, tag_uuid
             try:
                 if getattr(tag, "ndef", None):
-                    # Generate new UUID for the tag
-                    tag_uuid = uuid.uuid4()
-                    record = TextRecord(str(tag_uuid))
+                    # 16 random bytes as 22 URL-safe base64 chars; tags written earlier (hex, dashed UUID) still match as stored
+                    tag_uuid = secrets.token_urlsafe(16)
+                    record = TextRecord(tag_uuid)
                     tag.ndef.records = [record]
                     written = True
-                    message = f"Tag registered with UUID: {tag_uuid}"
-                    with Session(engine) as session:
-                        _save_student_with_tid(session, student_name, str(tag_uuid), student_data)
-                    print (message)
+                    message = f"Tag registered with ID: {tag_uuid}"
+                    log.info(message)
                 else:
                     message = "Tag is not NDEF-compatible"
-                    print(message)
+                    log.info(message)
                 return False
             except Exception as e:
                 message = f"Registration error: {repr(e)}"
-                print(message)
+                log.warning(message)
                 return False
-        start = time.time()
-        def terminate():
-            return (time.time() - start) > 20.0  # 20 second timeout to allow user to tap
-        acquired = _clf_lock.acquire(timeout=0.5)
-        if not acquired:
-            print("not found")
-            return {"written": False, "reason": "reader busy"}
         try:
-            try:
-                _clf.connect(rdwr={"on-connect": on_connect}, terminate=terminate)
-            except Exception as e:
-                print(f"erroer!!!{e}")
-                return {"written": False, "reason": f"connect error: {repr(e)}"}
-        finally:
-            _clf_lock.release()
+            await run_nfc_job(on_connect, 20.0)  # 20 second timeout to allow user to tap
+        except asyncio.TimeoutError:
+            log.info("register-tag: reader busy")
+            return {"written": False, "reason": "reader busy"}
+        except Exception as e:
+            log.warning("register-tag: connect error: %r", e)
+            return {"written": False, "reason": f"connect error: {repr(e)}"}
         if written:
-            print("written!!")
+            log.debug("register-tag: tag written")
             return {"written": True, "reason": message, "tag_uuid": tag_uuid}
         else:
-            print("timeout!!!")
+            log.info("register-tag: no tag presented within timeout")
             return {"written": False, "reason": message or "no tag presented within timeout"}
     # Informational: client should show "Please press NFC tag on reader" while awaiting.
-    result = await run_in_threadpool(register_tag)
+    result = await register_tag()
     if result.get("written", False):
-        tag_uuid = str(result["tag_uuid"])
-        with Session(engine) as session:
-            student, old_tid = _save_student_with_tid(session, student_name, tag_uuid, student_data)
-            # Log tag registration
-            log_action(
-                session,
-                current_user.id,
-                "tag_registered",
-                "student",
-                str(student.id),
-                f"Registered new tag {tag_uuid} for {student.name} (old: {old_tid})",
-                request.client.host,
-                request.headers.get("user-agent")
-            )
-            return {
-                "message": "Tag registered successfully",
-                "student_id": student.id,
-                "student_name": student.name,
-                "tag_uuid": tag_uuid,
-                "mode": "write"
-            }
+        tag_uuid = result["tag_uuid"]
+
+        def save_registration():
+            # The new tid and its audit entry go out in one transaction, once the tag is written
+            with SessionLocal() as session:
+                student, old_tid = _save_student_with_tid(session, student_name, tag_uuid, student_data)
+                # Log tag registration
+                add_log(
+                    session,
+                    current_user.id,
+                    "tag_registered",
+                    "student",
+                    str(student.id),
+                    f"Registered new tag {tag_uuid} for {student.name} (old: {old_tid})",
+                    request.client.host,
+                    request.headers.get("user-agent")
+                )
+                session.commit()
+            invalidate_check_in_status()
+            return student
+
+        student = await run_in_threadpool(save_registration)
+        return {
+            "message": "Tag registered successfully",
+            "student_id": student.id,
+            "student_name": student.name,
+            "tag_uuid": tag_uuid,
+            "mode": "write"
+        }
 
     else:
         raise HTTPException(status_code=504, detail=result.get("reason", "registration failed"))
 
 @app.get("/students")
-async def get_all_students(current_user: User = Depends(require_auth_level(1))):
-    """Get all students (teachers and IT staff view)"""
-    with Session(engine) as session:
-        students = session.exec(select(Student)).all()
-        return {"students": students}
+def get_all_students(
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    after_id: int = 0,
+    current_user: AuthedUser = Depends(require_auth_level(1)),
+    session: Session = Depends(get_session)
+):
+    """Get all students (teachers and IT staff view).
+    Pass `limit`, then the last id seen as `after_id`, to page through them instead."""
+    stmt = select(*Student.__table__.columns).where(Student.id > after_id).order_by(Student.id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    # Plain rows streamed off the cursor and encoded by orjson: no ORM instances or per-field validation
+    rows = session.exec(stmt.execution_options(yield_per=500))
+    return ORJSONResponse({"students": [row._asdict() for row in rows]})
 
 @app.post("/it/students")
-async def add_student_it(request: Request, student_data: StudentCreate, current_user: User = Depends(require_auth_level(2))):
+def add_student_it(request: Request, student_data: StudentCreate, current_user: AuthedUser = Depends(require_auth_level(2)), session: Session = Depends(get_session)):
     """Add a new student (IT staff and admin)"""
-    with Session(engine) as session:
-        # Check if student already exists
-        existing_student = session.exec(select(Student).where(Student.name == student_data.name)).first()
-        if existing_student:
-            raise HTTPException(status_code=400, detail="Student with this name already exists")
-        
-        # Create new student
-        new_student = Student(
-            name=student_data.name,
-            tid="",  # Will be set when tag is registered
-            lastscan=int(time.time()),
-            in_school=False,
-            schoolClass=student_data.class_name
-        )
-        session.add(new_student)
-        session.commit()
-        session.refresh(new_student)
-        
-        # Log student creation
-        log_action(
-            session,
-            current_user.id,
-            "student_created",
-            "student",
-            str(new_student.id),
-            f"IT staff created new student {new_student.name} in class {student_data.class_name}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
-        
-        return {"message": "Student created successfully", "student_id": new_student.id}
+    # Check if student already exists
+    existing_student = session.exec(select(Student).where(Student.name == student_data.name)).first()
+    if existing_student:
+        raise HTTPException(status_code=400, detail="Student with this name already exists")
+    
+    # Create new student
+    new_student = Student(
+        name=student_data.name,
+        tid="",  # Will be set when tag is registered
+        lastscan=int(time.time()),
+        in_school=False,
+        schoolClass=student_data.class_name
+    )
+    session.add(new_student)
+    session.flush()  # assigns new_student.id for the audit entry
+    
+    # Log student creation
+    add_log(
+        session,
+        current_user.id,
+        "student_created",
+        "student",
+        str(new_student.id),
+        f"IT staff created new student {new_student.name} in class {student_data.class_name}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
+    session.commit()
+    invalidate_check_in_status()
+    
+    return {"message": "Student created successfully", "student_id": new_student.id}
 
 @app.delete("/it/students/{student_id}")
-async def delete_student(student_id: int, request: Request, current_user: User = Depends(require_auth_level(2))):
+def delete_student(student_id: int, request: Request, current_user: AuthedUser = Depends(require_auth_level(2)), session: Session = Depends(get_session)):
     """Delete a student record (IT staff only)"""
-    with Session(engine) as session:
-        student = session.exec(select(Student).where(Student.id == student_id)).first()
-        if not student:
-            raise HTTPException(status_code=404, detail="Student not found")
-        
-        student_name = student.name
-        session.delete(student)
-        session.commit()
-        
-        # Log deletion
-        log_action(
-            session,
-            current_user.id,
-            "student_deleted",
-            "user",
-            str(student_id),
-            f"Deleted student {student_name}",
-            request.client.host,
-            request.headers.get("user-agent")
-        )
-        
-        return {"message": f"Student {student_name} deleted successfully"}
+    student = session.get(Student, student_id)
+    if not student:
+        raise HTTPException(status_code=404, detail="Student not found")
+    
+    student_name = student.name
+    session.delete(student)
+    
+    # Log deletion
+    add_log(
+        session,
+        current_user.id,
+        "student_deleted",
+        "user",
+        str(student_id),
+        f"Deleted student {student_name}",
+        request.client.host,
+        request.headers.get("user-agent")
+    )
+    session.commit()
+    invalidate_check_in_status()
+    
+    return {"message": f"Student {student_name} deleted successfully"}
+
+_AUDIT_LOG_PAGE = select(*AuditLog.__table__.columns).order_by(AuditLog.timestamp.desc()).limit(bindparam("limit"))
 
 @app.get("/it/audit-logs")
-async def get_audit_logs(current_user: User = Depends(require_auth_level(2))):
+def get_audit_logs(
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: AuthedUser = Depends(require_auth_level(2))
+):
     """Get audit logs (IT staff and admin only)"""
-    with Session(engine) as session:
-        logs = session.exec(select(AuditLog).order_by(AuditLog.timestamp.desc()).limit(100)).all()
-        return {"logs": logs}
+    return stream_rows("logs", _AUDIT_LOG_PAGE, {"limit": limit})
 
 @app.post("/it/register-tag")
-async def register_student_tag_it(request: Request, student_data: dict, current_user: User = Depends(require_auth_level(2))):
+async def register_student_tag_it(request: Request, student_data: dict, current_user: AuthedUser = Depends(require_auth_level(2))):
     """IT staff version of tag registration with additional features"""
     return await register_student_tag(request, student_data, current_user)
 
+# The headcounts ride along on every row as window aggregates, so the dashboard needs no second query
+_CHECK_IN_STATUS = select(
+    Student.id, Student.name, Student.tid, Student.in_school, Student.lastscan,
+    func.count().over().label("total"),
+    func.sum(case((Student.in_school == True, 1), else_=0)).over().label("in_school_count"),
+)
+
 @app.get("/teacher/check-in-status")
-async def get_check_in_status(current_user: User = Depends(require_auth_level(1))):
+def get_check_in_status(current_user: AuthedUser = Depends(require_auth_level(1)), session: Session = Depends(get_session)):
     """Get current check-in status for all students"""
-    with Session(engine) as session:
-        students = session.exec(select(Student)).all()
-        status_data = []
-        
-        for student in students:
-            status_data.append({
-                "id": student.id,
-                "name": student.name,
-                "tid": student.tid,
-                "in_school": student.in_school,
-                "last_scan": student.lastscan,
-                "last_scan_time": datetime.fromtimestamp(student.lastscan).isoformat() if student.lastscan else None
+    global _status_body
+    # Rebuilding under the lock lets one poll query while the others wait for its result
+    with _status_lock:
+        if _status_body is None:
+            # Plain column tuples: no ORM instances for what is a read-only dump of every student
+            rows = session.exec(_CHECK_IN_STATUS).all()
+            fromtimestamp = datetime.fromtimestamp
+            # Students arriving together share lastscan seconds; format each distinct value once
+            iso_by_ts = {}
+            status_data = [
+                {
+                    "id": student_id,
+                    "name": name,
+                    "tid": tid,
+                    "in_school": in_school,
+                    "last_scan": lastscan,
+                    "last_scan_time": (
+                        iso_by_ts.get(lastscan) or iso_by_ts.setdefault(lastscan, fromtimestamp(lastscan).isoformat())
+                    ) if lastscan else None
+                }
+                for student_id, name, tid, in_school, lastscan, _, _ in rows
+            ]
+            total, in_school_count = (rows[0].total, rows[0].in_school_count) if rows else (0, 0)
+            _status_body = orjson.dumps({
+                "students": status_data,
+                "total": total,
+                "in_school_count": in_school_count
             })
-        
-        return {"students": status_data}
+        body = _status_body
+    return Response(body, media_type="application/json")
+
+_CHECK_IN_LOG_ACTIONS = ("check_in_with_duty_teacher", "check_out_with_duty_teacher")
+# Built once like the tap statements; limit and cursor are bound per request
+_CHECK_IN_LOGS = (
+    select(AuditLog.id, AuditLog.user_id, AuditLog.action, AuditLog.timestamp, AuditLog.details, AuditLog.ip_address)
+    .where(AuditLog.action.in_(_CHECK_IN_LOG_ACTIONS))
+    .order_by(AuditLog.timestamp.desc())
+    .limit(bindparam("limit"))
+)
+# Range on the indexed timestamp instead of an OFFSET that rereads skipped rows
+_CHECK_IN_LOGS_BEFORE = _CHECK_IN_LOGS.where(AuditLog.timestamp < bindparam("before"))
 
 @app.get("/teacher/check-in-logs")
-async def get_check_in_logs(current_user: User = Depends(require_auth_level(1))):
-    """Get recent check-in/out logs"""
-    with Session(engine) as session:
-        # Get logs for check-in/out actions with duty teacher association
-        logs = session.exec(
-            select(AuditLog)
-            .where(AuditLog.action.in_(["check_in_with_duty_teacher", "check_out_with_duty_teacher"]))
-            .order_by(AuditLog.timestamp.desc())
-            .limit(50)
-        ).all()
-        
-        log_data = []
-        for log in logs:
-            log_data.append({
-                "id": log.id,
-                "user_id": log.user_id,
-                "action": log.action,
-                "timestamp": log.timestamp.isoformat(),
-                "details": log.details,
-                "ip_address": log.ip_address
-            })
-        
-        return {"logs": log_data}
+def get_check_in_logs(
+    limit: int = Query(50, ge=1, le=1000),
+    before: Optional[datetime] = None,
+    current_user: AuthedUser = Depends(require_auth_level(1)),
+    session: Session = Depends(get_session)
+):
+    """Get recent check-in/out logs, newest first. Pass the last timestamp of a page as
+    `before` to get the next one."""
+    # Get logs for check-in/out actions with duty teacher association
+    if before is None:
+        rows = session.exec(_CHECK_IN_LOGS, params={"limit": limit})
+    else:
+        rows = session.exec(_CHECK_IN_LOGS_BEFORE, params={"limit": limit, "before": before})
+    # orjson writes the datetimes in the same ISO format isoformat() produced
+    return ORJSONResponse({"logs": [row._asdict() for row in rows]})
 
 # --- Admin Level 3 System Management Endpoints ---
+# Every count the metrics and report endpoints show, in one round trip: one pass over User,
+# one over Student and a seek on ix_auditlog_action_timestamp for the check-ins.
+# COUNT(*) rather than COUNT(id) leaves SQLite free to count the smallest index.
+_USER_COUNTS = select(
+    func.count().label("total_users"),
+    func.count(case((User.is_active == True, 1))).label("active_users"),
+).subquery()
+_STUDENT_COUNTS = select(func.count().label("total_students")).select_from(Student).subquery()
+_CHECKIN_COUNTS = select(
+    func.count().label("total_checkins"),
+    func.count(case((and_(AuditLog.timestamp >= bindparam("today_start"), AuditLog.timestamp < bindparam("today_end")), 1))).label("today_checkins"),
+).where(AuditLog.action.in_(["check_in_with_duty_teacher", "check_in"])).subquery()
+# Each side is a single row, so joining them on true() just puts the counts side by side
+_SYSTEM_COUNTS = select(_USER_COUNTS, _STUDENT_COUNTS, _CHECKIN_COUNTS).select_from(
+    _USER_COUNTS.join(_STUDENT_COUNTS, true()).join(_CHECKIN_COUNTS, true())
+)
+
+def system_counts(session: Session):
+    # today_* bound the day as a range on the bare column so the index can answer it
+    today_start = datetime.combine(datetime.now().date(), datetime.min.time())
+    return session.exec(_SYSTEM_COUNTS, params={"today_start": today_start, "today_end": today_start + timedelta(days=1)}).one()
+
 @app.get("/admin/system-metrics")
-async def get_system_metrics(current_user: User = Depends(require_auth_level(3))):
+def get_system_metrics(current_user: AuthedUser = Depends(require_auth_level(3)), session: Session = Depends(get_session)):
     """Get system metrics for analytics dashboard (admin only)"""
-    from sqlalchemy import func
+    counts = system_counts(session)
     
-    with Session(engine) as session:
-        # Count total users
-        total_users_result = session.exec(select(func.count(User.id))).one()
-        total_users = total_users_result if total_users_result else 0
-        
-        # Count active users
-        active_users_result = session.exec(select(func.count(User.id)).where(User.is_active == True)).one()
-        active_users = active_users_result if active_users_result else 0
-        
-        # Count total check-ins from audit logs
-        total_checkins_result = session.exec(
-            select(func.count(AuditLog.id)).where(AuditLog.action.in_(["check_in_with_duty_teacher", "check_in"]))
-        ).one()
-        total_checkins = total_checkins_result if total_checkins_result else 0
-        
-        # Count today's check-ins
-        today = datetime.now().date()
-        today_checkins_result = session.exec(
-            select(func.count(AuditLog.id))
-            .where(AuditLog.action.in_(["check_in_with_duty_teacher", "check_in"]))
-            .where(func.date(AuditLog.timestamp) == today)
-        ).one()
-        today_checkins = today_checkins_result if today_checkins_result else 0
-        
-        # Get system uptime (mock data for now)
-        system_uptime = "3d 14h 32m"
-        
-        # Get database size (mock data for now)
-        database_size = "125.4 MB"
-        
-        # Get NFC reader status
-        nfc_reader_status = "active" if _clf else "inactive"
-        
-        return {
-            "total_users": total_users,
-            "active_users": active_users,
-            "total_checkins": total_checkins,
-            "today_checkins": today_checkins,
-            "system_uptime": system_uptime,
-            "database_size": database_size,
-            "nfc_reader_status": nfc_reader_status
-        }
+    # Get system uptime (mock data for now)
+    system_uptime = "3d 14h 32m"
+    
+    # Get database size (mock data for now)
+    database_size = "125.4 MB"
+    
+    # Get NFC reader status
+    nfc_reader_status = "active" if _clf else "inactive"
+    
+    return {
+        "total_users": counts.total_users,
+        "active_users": counts.active_users,
+        "total_checkins": counts.total_checkins,
+        "today_checkins": counts.today_checkins,
+        "system_uptime": system_uptime,
+        "database_size": database_size,
+        "nfc_reader_status": nfc_reader_status
+    }
+
+# Default configuration (in real implementation, this would be stored in database).
+# It never changes, so it is encoded once rather than per dashboard poll.
+_SYSTEM_CONFIG_BODY = orjson.dumps({
+    "auto_backup_enabled": True,
+    "backup_frequency": "daily",
+    "session_timeout": 30,
+    "max_login_attempts": 5,
+    "nfc_scan_timeout": 10,
+    "enable_notifications": True
+})
 
 @app.get("/admin/system-config")
-async def get_system_config(current_user: User = Depends(require_auth_level(3))):
+async def get_system_config(current_user: AuthedUser = Depends(require_auth_level(3))):
     """Get system configuration (admin only)"""
-    # Return default configuration (in real implementation, this would be stored in database)
-    return {
-        "auto_backup_enabled": True,
-        "backup_frequency": "daily",
-        "session_timeout": 30,
-        "max_login_attempts": 5,
-        "nfc_scan_timeout": 10,
-        "enable_notifications": True
-    }
+    return Response(_SYSTEM_CONFIG_BODY, media_type="application/json")
 
 @app.put("/admin/system-config")
 async def update_system_config(
     config: dict,
     request: Request,
-    current_user: User = Depends(require_auth_level(3))
+    current_user: AuthedUser = Depends(require_auth_level(3))
 ):
     """Update system configuration (admin only)"""
     # In real implementation, this would save to database
-    with Session(engine) as session:
-        log_action(
-            session,
-            current_user.id,
-            "system_config_updated",
-            "system",
-            None,
-            f"System configuration updated by {current_user.name}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
+    enqueue_audit(
+        current_user.id,
+        "system_config_updated",
+        "system",
+        None,
+        f"System configuration updated by {current_user.name}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
     
     return {"message": "System configuration updated successfully"}
 
 @app.get("/admin/audit-logs")
-async def get_admin_audit_logs(current_user: User = Depends(require_auth_level(3))):
+def get_admin_audit_logs(current_user: AuthedUser = Depends(require_auth_level(3)), session: Session = Depends(get_session)):
     """Get audit logs for admin dashboard"""
-    with Session(engine) as session:
-        logs = session.exec(
-            select(AuditLog)
-            .order_by(AuditLog.timestamp.desc())
-            .limit(100)
-        ).all()
-        
-        log_data = []
-        for log in logs:
-            log_data.append({
-                "id": log.id,
-                "user_id": log.user_id,
-                "action": log.action,
-                "timestamp": log.timestamp.isoformat(),
-                "details": log.details,
-                "ip_address": log.ip_address
-            })
-        
-        return {"logs": log_data}
+    rows = session.exec(
+        select(AuditLog.id, AuditLog.user_id, AuditLog.action, AuditLog.timestamp, AuditLog.details, AuditLog.ip_address)
+        .order_by(AuditLog.timestamp.desc())
+        .limit(100)
+    )
+    return ORJSONResponse({"logs": [row._asdict() for row in rows]})
 
 @app.get("/admin/users/{user_id}/role")
-async def update_user_role(
+def update_user_role(
     user_id: int,
     role: str,
     request: Request,
-    current_user: User = Depends(require_auth_level(3))
+    current_user: AuthedUser = Depends(require_auth_level(3)),
+    session: Session = Depends(get_session)
 ):
     """Update user role (admin only)"""
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.id == user_id)).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        old_role = user.role
-        user.role = UserRole(role)
-        # Update auth level based on role
-        role_to_level = {
-            "teacher": 1,
-            "it_staff": 2, 
-            "admin": 3
-        }
-        user.auth_level = role_to_level.get(role, 1)  # Default to teacher level
-        session.commit()
-        
-        # Log role change
-        log_action(
-            session,
-            current_user.id,
-            "user_role_updated",
-            "user",
-            str(user_id),
-            f"Updated {user.name} role from {old_role} to {user.role}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
-        
-        return {"message": f"User role updated to {user.role}"}
+    user = session.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    old_role = user.role
+    user.role = UserRole(role)
+    # Update auth level based on role
+    user.auth_level = ROLE_AUTH_LEVEL[user.role]
+    
+    # Log role change
+    add_log(
+        session,
+        current_user.id,
+        "user_role_updated",
+        "user",
+        str(user_id),
+        f"Updated {user.name} role from {old_role} to {user.role}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
+    session.commit()
+    invalidate_user(user_id)
+    
+    return {"message": f"User role updated to {user.role}"}
 
 # --- Quick Action Endpoints ---
 @app.post("/admin/generate-report")
-async def generate_system_report(request: Request, current_user: User = Depends(require_auth_level(3))):
+def generate_system_report(request: Request, current_user: AuthedUser = Depends(require_auth_level(3)), session: Session = Depends(get_session)):
     """Generate system report (admin only)"""
-    with Session(engine) as session:
-        # Generate report data
-        total_users = session.exec(select(func.count(User.id))).one()
-        active_users = session.exec(select(func.count(User.id)).where(User.is_active == True)).one()
-        total_students = session.exec(select(func.count(Student.id))).one()
-        total_checkins = session.exec(
-            select(func.count(AuditLog.id)).where(AuditLog.action.in_(["check_in_with_duty_teacher", "check_in"]))
-        ).one()
-        
-        report_data = {
-            "generated_at": datetime.now().isoformat(),
-            "total_users": total_users,
-            "active_users": active_users,
-            "total_students": total_students,
-            "total_checkins": total_checkins,
-            "system_status": "operational"
-        }
-        
-        # Log report generation
-        log_action(
-            session,
-            current_user.id,
-            "system_report_generated",
-            "system",
-            None,
-            f"System report generated by {current_user.name}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
-        
-        return {"message": "System report generated successfully", "report": report_data}
+    # Generate report data
+    counts = system_counts(session)
+    
+    report_data = {
+        "generated_at": datetime.now().isoformat(),
+        "total_users": counts.total_users,
+        "active_users": counts.active_users,
+        "total_students": counts.total_students,
+        "total_checkins": counts.total_checkins,
+        "system_status": "operational"
+    }
+    
+    # Log report generation
+    enqueue_audit(
+        current_user.id,
+        "system_report_generated",
+        "system",
+        None,
+        f"System report generated by {current_user.name}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
+    
+    return {"message": "System report generated successfully", "report": report_data}
 
 @app.post("/admin/export-data")
-async def export_all_data(request: Request, current_user: User = Depends(require_auth_level(3))):
+def export_all_data(request: Request, current_user: AuthedUser = Depends(require_auth_level(3))):
     """Export all system data (admin only)"""
-    with Session(engine) as session:
-        # Get all users
-        users = session.exec(select(User)).all()
-        
-        # Get all students
-        students = session.exec(select(Student)).all()
-        
-        # Get recent audit logs
-        audit_logs = session.exec(
-            select(AuditLog)
-            .order_by(AuditLog.timestamp.desc())
-            .limit(1000)
-        ).all()
-        
-        export_data = {
-            "exported_at": datetime.now().isoformat(),
-            "users": [user.dict() for user in users],
-            "students": [student.dict() for student in students],
-            "audit_logs": [log.dict() for log in audit_logs]
-        }
-        
-        # Log data export
-        log_action(
-            session,
-            current_user.id,
-            "data_exported",
-            "system",
-            None,
-            f"Data exported by {current_user.name}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
-        
-        return {"message": "Data exported successfully", "data": export_data}
+    # Log data export
+    enqueue_audit(
+        current_user.id,
+        "data_exported",
+        "system",
+        None,
+        f"Data exported by {current_user.name}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
+
+    # Whole tables: stream each one off its cursor instead of building every row as an ORM
+    # instance and then again as a dict
+    def body():
+        with SessionLocal() as session:
+            yield b'{"message":"Data exported successfully","data":{"exported_at":' + orjson.dumps(datetime.now())
+            yield b',"users":'
+            yield from json_array(session, select(*User.__table__.columns))
+            yield b',"students":'
+            yield from json_array(session, select(*Student.__table__.columns))
+            yield b',"audit_logs":'
+            # Recent audit logs
+            yield from json_array(session, select(*AuditLog.__table__.columns).order_by(AuditLog.timestamp.desc()).limit(1000))
+            yield b"}}"
+    return StreamingResponse(body(), media_type="application/json")
 
 @app.post("/admin/create-backup")
-async def create_system_backup(request: Request, current_user: User = Depends(require_auth_level(3))):
+async def create_system_backup(request: Request, current_user: AuthedUser = Depends(require_auth_level(3))):
     """Create system backup (admin only)"""
     # Simulate backup creation
     backup_data = {
@@ -1273,23 +1806,21 @@ async def create_system_backup(request: Request, current_user: User = Depends(re
         "status": "completed"
     }
     
-    with Session(engine) as session:
-        # Log backup creation
-        log_action(
-            session,
-            current_user.id,
-            "backup_created",
-            "system",
-            None,
-            f"System backup created by {current_user.name}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
+    # Log backup creation
+    enqueue_audit(
+        current_user.id,
+        "backup_created",
+        "system",
+        None,
+        f"System backup created by {current_user.name}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
     
     return {"message": "System backup created successfully", "backup": backup_data}
 
 @app.post("/admin/maintenance")
-async def perform_maintenance(request: Request, current_user: User = Depends(require_auth_level(3))):
+async def perform_maintenance(request: Request, current_user: AuthedUser = Depends(require_auth_level(3))):
     """Perform system maintenance (admin only)"""
     # Simulate maintenance tasks
     maintenance_tasks = [
@@ -1299,160 +1830,161 @@ async def perform_maintenance(request: Request, current_user: User = Depends(req
         "System health check passed"
     ]
     
-    with Session(engine) as session:
-        # Log maintenance
-        log_action(
-            session,
-            current_user.id,
-            "maintenance_performed",
-            "system",
-            None,
-            f"System maintenance performed by {current_user.name}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
+    # Log maintenance
+    enqueue_audit(
+        current_user.id,
+        "maintenance_performed",
+        "system",
+        None,
+        f"System maintenance performed by {current_user.name}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
     
     return {"message": "System maintenance completed", "tasks": maintenance_tasks}
 
 @app.post("/admin/emergency-shutdown")
-async def emergency_shutdown(request: Request, current_user: User = Depends(require_auth_level(3))):
+async def emergency_shutdown(request: Request, current_user: AuthedUser = Depends(require_auth_level(3))):
     """Emergency system shutdown (admin only)"""
-    with Session(engine) as session:
-        # Log emergency shutdown
-        log_action(
-            session,
-            current_user.id,
-            "emergency_shutdown",
-            "system",
-            None,
-            f"Emergency shutdown initiated by {current_user.name}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
+    # Log emergency shutdown
+    enqueue_audit(
+        current_user.id,
+        "emergency_shutdown",
+        "system",
+        None,
+        f"Emergency shutdown initiated by {current_user.name}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
     
     return {"message": "Emergency shutdown initiated. System will restart automatically."}
 
 # --- Admin Level 3 Endpoints ---
+_USER_LIST = select(User.id, User.name, User.is_active, User.role, User.auth_level, User.assigned_duty)
+
 @app.get("/admin/users")
-async def list_users(current_user: User = Depends(require_auth_level(3))):
+def list_users(current_user: AuthedUser = Depends(require_auth_level(3)), session: Session = Depends(get_session)):
     """List all users (admin only)"""
-    with Session(engine) as session:
-        users = session.exec(select(User)).all()
-        return {"users": users}
+    # User has no relationships to load; select the listed columns and leave the password hash out
+    rows = session.exec(_USER_LIST)
+    return ORJSONResponse({"users": [row._asdict() for row in rows]})
 
 @app.post("/admin/students")
-async def add_student_admin(request: Request, student_data: StudentCreate, current_user: User = Depends(require_auth_level(3))):
+def add_student_admin(request: Request, student_data: StudentCreate, current_user: AuthedUser = Depends(require_auth_level(3)), session: Session = Depends(get_session)):
     """Add a new student (admin only)"""
-    with Session(engine) as session:
-        # Check if student already exists
-        existing_student = session.exec(select(Student).where(Student.name == student_data.name)).first()
-        if existing_student:
-            raise HTTPException(status_code=400, detail="Student with this name already exists")
-        
-        # Create new student
-        new_student = Student(
-            name=student_data.name,
-            tid="",  # Will be set when tag is registered
-            lastscan=int(time.time()),
-            in_school=False,
-            schoolClass=student_data.class_name
-        )
-        session.add(new_student)
-        session.commit()
-        session.refresh(new_student)
-        
-        # Log student creation
-        log_action(
-            session,
-            current_user.id,
-            "student_created",
-            "student",
-            str(new_student.id),
-            f"Admin created new student {new_student.name} in class {student_data.class_name}",
-            request.client.host if request else None,
-            request.headers.get("user-agent") if request else None
-        )
-        
-        return {"message": "Student created successfully", "student_id": new_student.id}
+    # Check if student already exists
+    existing_student = session.exec(select(Student).where(Student.name == student_data.name)).first()
+    if existing_student:
+        raise HTTPException(status_code=400, detail="Student with this name already exists")
+    
+    # Create new student
+    new_student = Student(
+        name=student_data.name,
+        tid="",  # Will be set when tag is registered
+        lastscan=int(time.time()),
+        in_school=False,
+        schoolClass=student_data.class_name
+    )
+    session.add(new_student)
+    session.flush()  # assigns new_student.id for the audit entry
+    
+    # Log student creation
+    add_log(
+        session,
+        current_user.id,
+        "student_created",
+        "student",
+        str(new_student.id),
+        f"Admin created new student {new_student.name} in class {student_data.class_name}",
+        request.client.host if request else None,
+        request.headers.get("user-agent") if request else None
+    )
+    session.commit()
+    invalidate_check_in_status()
+    
+    return {"message": "Student created successfully", "student_id": new_student.id}
 
 @app.delete("/admin/users/{user_id}")
-async def delete_user(user_id: int, request: Request, current_user: User = Depends(require_auth_level(3))):
+def delete_user(user_id: int, request: Request, current_user: AuthedUser = Depends(require_auth_level(3)), session: Session = Depends(get_session)):
     """Delete any user (admin only)"""
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.id == user_id)).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user_name = user.name
-        session.delete(user)
-        session.commit()
-        
-        # Log deletion
-        log_action(
-            session,
-            current_user.id,
-            "user_deleted",
-            "user",
-            str(user_id),
-            f"Deleted user {user_name}",
-            request.client.host,
-            request.headers.get("user-agent")
-        )
-        
-        return {"message": f"User {user_name} deleted successfully"}
+    # One DELETE ... RETURNING instead of loading the row first
+    deleted = session.exec(
+        delete(User).where(User.id == user_id).returning(User.name, User.assigned_duty)
+    ).first()
+    if deleted is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    user_name, was_on_duty = deleted
+    
+    # Log deletion
+    add_log(
+        session,
+        current_user.id,
+        "user_deleted",
+        "user",
+        str(user_id),
+        f"Deleted user {user_name}",
+        request.client.host,
+        request.headers.get("user-agent")
+    )
+    session.commit()
+    invalidate_user(user_id)
+    if was_on_duty:
+        invalidate_duty_teacher()
+    
+    return {"message": f"User {user_name} deleted successfully"}
 
 @app.get("/admin/users/{user_id}/deactivate")
-async def deactivate_user(user_id: int, request: Request, current_user: User = Depends(require_auth_level(3))):
+def deactivate_user(user_id: int, request: Request, current_user: AuthedUser = Depends(require_auth_level(3)), session: Session = Depends(get_session)):
     """Deactivate user (admin only)"""
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.id == user_id)).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user.is_active = False
-        session.commit()
-        
-        # Log deactivation
-        log_action(
-            session,
-            current_user.id,
-            "user_deactivated",
-            "user",
-            str(user_id),
-            f"Deactivated user {user.name}",
-            request.client.host,
-            request.headers.get("user-agent")
-        )
-        
-        return {"message": f"User {user.name} deactivated successfully"}
+    user_name = session.exec(
+        update(User).where(User.id == user_id).values(is_active=False).returning(User.name)
+    ).scalar_one_or_none()
+    if user_name is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Log deactivation
+    add_log(
+        session,
+        current_user.id,
+        "user_deactivated",
+        "user",
+        str(user_id),
+        f"Deactivated user {user_name}",
+        request.client.host,
+        request.headers.get("user-agent")
+    )
+    session.commit()
+    invalidate_user(user_id)
+    
+    return {"message": f"User {user_name} deactivated successfully"}
 
 @app.get("/admin/users/{user_id}/activate")
-async def activate_user(user_id: int, request: Request, current_user: User = Depends(require_auth_level(3))):
+def activate_user(user_id: int, request: Request, current_user: AuthedUser = Depends(require_auth_level(3)), session: Session = Depends(get_session)):
     """Activate user (admin only)"""
-    with Session(engine) as session:
-        user = session.exec(select(User).where(User.id == user_id)).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user.is_active = True
-        session.commit()
-        
-        # Log activation
-        log_action(
-            session,
-            current_user.id,
-            "user_activated",
-            "user",
-            str(user_id),
-            f"Activated user {user.name}",
-            request.client.host,
-            request.headers.get("user-agent")
-        )
-        
-        return {"message": f"User {user.name} activated successfully"}
+    user_name = session.exec(
+        update(User).where(User.id == user_id).values(is_active=True).returning(User.name)
+    ).scalar_one_or_none()
+    if user_name is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Log activation
+    add_log(
+        session,
+        current_user.id,
+        "user_activated",
+        "user",
+        str(user_id),
+        f"Activated user {user_name}",
+        request.client.host,
+        request.headers.get("user-agent")
+    )
+    session.commit()
+    invalidate_user(user_id)
+    
+    return {"message": f"User {user_name} activated successfully"}
 
 @app.get("/write/{string}")
-async def write_item(string: str, current_user: User = Depends(get_current_active_user)):
+async def write_item(string: str, current_user: AuthedUser = Depends(get_current_active_user)):
     """
     Waits up to 10 seconds for a tag, then writes a TextRecord containing the 'string'.
     Returns JSON: {"written": True/False, "reason": "..."
@@ -1461,151 +1993,148 @@ async def write_item(string: str, current_user: User = Depends(get_current_activ
     if _clf is None:
         raise HTTPException(status_code=503, detail="NFC reader not available")
 
-    def write_connect():
-        written = False
-        message = None
-
-        def on_connect(tag):
-            nonlocal written, message
-            try:
-                if getattr(tag, "ndef", None):
-                    record = TextRecord(string)
-                    tag.ndef.records = [record]
-                    written = True
-                    message = f"Tag written with TextRecord: {string}"
-                    print(message)
-                else:
-                    message = "Tag is not NDEF-compatible"
-                    print(message)
-                return False
-            except Exception as e:
-                message = f"Write error: {repr(e)}"
-                print(message)
-                return False
-
-        start = time.time()
-
-        def terminate():
-            return (time.time() - start) > 10.0  # 10 second timeout
-
-        acquired = _clf_lock.acquire(timeout=0.5)
-        if not acquired:
-            return {"written": False, "reason": "reader busy"}
+    written = False
+    message = None
 
+    def on_connect(tag):
+        nonlocal written, message
         try:
-            try:
-                _clf.connect(rdwr={"on-connect": on_connect}, terminate=terminate)
-            except Exception as e:
-                return {"written": False, "reason": f"connect error: {repr(e)}"}
-        finally:
-            _clf_lock.release()
+            if getattr(tag, "ndef", None):
+                record = TextRecord(string)
+                tag.ndef.records = [record]
+                written = True
+                message = f"Tag written with TextRecord: {string}"
+                log.info(message)
+            else:
+                message = "Tag is not NDEF-compatible"
+                log.info(message)
+            return False
+        except Exception as e:
+            message = f"Write error: {repr(e)}"
+            log.warning(message)
+            return False
 
-        if written:
-            return {"written": True, "reason": message}
-        else:
-            return {"written": False, "reason": message or "no tag presented within timeout"}
+    try:
+        await run_nfc_job(on_connect, 10.0)  # 10 second timeout
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="reader busy")
+    except Exception as e:
+        raise HTTPException(status_code=504, detail=f"connect error: {repr(e)}")
 
-    result = await run_in_threadpool(write_connect)
-    if not result.get("written", False):
-        raise HTTPException(status_code=504, detail=result.get("reason", "write failed"))
-    return result
+    if not written:
+        raise HTTPException(status_code=504, detail=message or "no tag presented within timeout")
+    return {"written": True, "reason": message}
 
 @app.post("/newTag")
-async def write_item(newTag: newUser, current_user: User = Depends(require_auth_level(1))):
+async def write_item(newTag: NewTag, current_user: AuthedUser = Depends(require_auth_level(1))):
     """Adapted endpoint for teachers and above to register new NFC tags"""
     global _clf
     if _clf is None:
         raise HTTPException(status_code=503, detail="NFC reader not available")
     
-    def write_connect():
-        written = False
-        message = None
-        new_uuid = None
-        
-        def on_connect(tag):
-            nonlocal written, message, new_uuid
-            try:
-                if getattr(tag, "ndef", None):
-                    if tag.ndef:
-                        # Generate new UUID for the tag
-                        new_uuid = uuid.uuid4()
-                        
-                        # Write the UUID to the tag
-                        record = TextRecord(str(new_uuid))
-                        tag.ndef.records = [record]
-                        
-                        written = True
-                        message = f"Tag registered with UUID: {new_uuid}"
-                        print(message)
-                    else:
-                        message = "Tag has no NDEF records"
-                        print(message)
-                else:
-                    message = "Tag is not NDEF-compatible"
-                    print(message)
-                return False
-            except Exception as e:
-                message = f"Registration error: {repr(e)}"
-                print(message)
-                return False
-
-        start = time.time()
-
-        def terminate():
-            return (time.time() - start) > 10.0  # 10 second timeout
-
-        acquired = _clf_lock.acquire(timeout=0.5)
-        if not acquired:
-            return {"written": False, "reason": "reader busy"}
-
-        try:
-            try:
-                _clf.connect(rdwr={"on-connect": on_connect}, terminate=terminate)
-            except Exception as e:
-                return {"written": False, "reason": f"connect error: {repr(e)}"}
-        finally:
-            _clf_lock.release()
-
-        if written:
-            return {"written": True, "reason": message, "tag_uuid": new_uuid}
-        else:
-            return {"written": False, "reason": message or "no tag presented within timeout"}
-
-    result = await run_in_threadpool(write_connect)
+    written = False
+    already_registered = False
+    message = None
+    new_uuid = None
     
-    if result.get("written", False):
-        # Update user record with new tag
-        with Session(engine) as session:
-            # Check if user already exists
-            existing_user = session.exec(select(Student).where(Student.id == newTag.id)).first()
-            if not existing_user:
+    def on_connect(tag):
+        nonlocal written, already_registered, message, new_uuid
+        try:
+            if getattr(tag, "ndef", None):
+                if old_tid and first_text(tag.ndef.records) == old_tid:
+                    # Double tap or client retry: the tag already carries this student's id,
+                    # so leave it and the database as they are
+                    new_uuid = old_tid
+                    already_registered = True
+                    message = f"Tag already registered with ID: {old_tid}"
+                    log.info(message)
+                elif tag.ndef:
+                    # 16 random bytes as 22 URL-safe base64 chars; tags written earlier (hex, dashed UUID) still match as stored
+                    new_uuid = secrets.token_urlsafe(16)
+                    
+                    # Write the ID to the tag
+                    record = TextRecord(new_uuid)
+                    tag.ndef.records = [record]
+                    
+                    written = True
+                    message = f"Tag registered with ID: {new_uuid}"
+                    log.info(message)
+                else:
+                    message = "Tag has no NDEF records"
+                    log.info(message)
+            else:
+                message = "Tag is not NDEF-compatible"
+                log.info(message)
+            return False
+        except Exception as e:
+            message = f"Registration error: {repr(e)}"
+            log.warning(message)
+            return False
+
+    def load_student():
+        with SessionLocal() as session:
+            return session.exec(select(Student.tid, Student.name).where(Student.id == newTag.id)).first()
+
+    def save_tag(tag_uuid: str):
+        # Runs in the threadpool so the DB round-trips never block the event loop
+        with SessionLocal() as session:
+            # One statement updates the row and hands back the name for the log;
+            # None means the student was deleted while the tag was being written
+            user_name = session.exec(
+                update(Student)
+                .where(Student.id == newTag.id)
+                .values(tid=tag_uuid, lastscan=int(time.time()))
+                .returning(Student.name)
+            ).scalar_one_or_none()
+            if user_name is None:
                 raise HTTPException(status_code=404, detail="User not found")
             
-            old_tid = existing_user.tid
-            existing_user.tid = str(result["tag_uuid"])
-            existing_user.lastscan = int(time.time())
-            session.commit()
-            
-            # Log tag registration
-            log_action(
+            # Log tag registration in the same transaction as the student update
+            add_log(
                 session,
                 current_user.id,
                 "tag_registered",
                 "user",
                 str(newTag.id),
-                f"Registered new tag {result['tag_uuid']} for {existing_user.name} (old: {old_tid})",
+                f"Registered new tag {tag_uuid} for {user_name} (old: {old_tid})",
                 None,
                 None
             )
-            
-            return {
-                "message": "Tag registered successfully",
-                "user_id": newTag.id,
-                "user_name": existing_user.name,
-                "tag_uuid": result["tag_uuid"]
-            }
+            session.commit()
+            invalidate_check_in_status()
+            return user_name
+
+    # Check if user already exists before engaging the reader, so a bad id never consumes a tag
+    student = await run_in_threadpool(load_student)
+    if student is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    old_tid, student_name = student
+
+    try:
+        await run_nfc_job(on_connect, 10.0)  # 10 second timeout
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="reader busy")
+    except Exception as e:
+        raise HTTPException(status_code=504, detail=f"connect error: {repr(e)}")
+    
+    if already_registered:
+        return {
+            "message": "Tag already registered",
+            "user_id": newTag.id,
+            "user_name": student_name,
+            "tag_uuid": new_uuid
+        }
+    if written:
+        # Update user record with new tag
+        user_name = await run_in_threadpool(save_tag, new_uuid)
+        return {
+            "message": "Tag registered successfully",
+            "user_id": newTag.id,
+            "user_name": user_name,
+            "tag_uuid": new_uuid
+        }
     else:
-        raise HTTPException(status_code=504, detail=result.get("reason", "registration failed"))
+        raise HTTPException(status_code=504, detail=message or "no tag presented within timeout")
 
 # WebSocket endpoint for real-time notifications
 @app.websocket("/ws")
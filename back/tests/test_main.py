@@ -3,11 +3,16 @@ import unittest
 import uuid
 import time
 from fastapi.testclient import TestClient
-from main import app, engine, get_password_hash, verify_password, create_access_token, authenticate_user
+from main import app, engine, get_password_hash, verify_password, create_access_token, authenticate_user, decode_token, process_nfc_scan, init_db, enqueue_audit, audit_flusher
+import main
 from sqlmodel import Session, select
 from datetime import datetime, timedelta
 from main import User, Student, AuditLog, UserRole, UserCreate, UserLogin
 
+def setUpModule():
+    # The TestClient is used without a with-block, so lifespan never creates the schema
+    init_db()
+
 class TestAuthentication(unittest.TestCase):
     """Test authentication functions and user management"""
     
@@ -21,7 +26,15 @@ class TestAuthentication(unittest.TestCase):
         self.assertTrue(verify_password(password, hashed))
         self.assertFalse(verify_password("wrong", hashed))
         self.assertFalse(verify_password("", hashed))
-        
+
+    def test_legacy_password_hash(self):
+        """Test SHA-256 hashes from before Argon2 still verify"""
+        import hashlib
+        legacy = hashlib.sha256(b"test123").hexdigest()
+        self.assertTrue(verify_password("test123", legacy))
+        self.assertFalse(verify_password("wrong", legacy))
+        self.assertTrue(get_password_hash("test123").startswith("$argon2id$"))
+
     def test_create_access_token(self):
         """Test JWT token creation"""
         data = {"sub": "testuser", "user_id": 1, "role": "teacher"}
@@ -32,6 +45,16 @@ class TestAuthentication(unittest.TestCase):
         # Test with expiration
         token_expires = create_access_token(data, expires_delta=timedelta(minutes=5))
         self.assertIsInstance(token_expires, str)
+
+    def test_decode_token_cache_honours_expiry(self):
+        """Test that a cached token stops validating once it expires"""
+        token = create_access_token({"sub": "testuser", "user_id": 1, "role": "teacher"},
+                                    expires_delta=timedelta(seconds=1))
+        self.assertEqual(decode_token(token).user_id, 1)
+        self.assertEqual(decode_token(token).user_id, 1)  # served from the cache
+        time.sleep(2)
+        self.assertIsNone(decode_token(token))
+        self.assertIsNone(decode_token(token + "x"))
         
     def test_user_registration(self):
         """Test user registration endpoint"""
@@ -49,6 +72,16 @@ class TestAuthentication(unittest.TestCase):
         self.assertEqual(data["user_role"], UserRole.TEACHER)
         self.assertTrue("user_id" in data)
         
+    def test_authenticate_user_repeat_login(self):
+        """Test that a cached login still rejects a wrong password"""
+        username = f"repeatlogin_{uuid.uuid4().hex[:8]}"
+        self.client.post("/register", json={"username": username, "password": "repeatpass123", "role": UserRole.TEACHER})
+        with Session(engine) as session:
+            first = authenticate_user(session, username, "repeatpass123")
+            second = authenticate_user(session, username, "repeatpass123")
+            self.assertEqual(first.id, second.id)
+            self.assertFalse(authenticate_user(session, username, "wrongpass"))
+
     def test_user_login(self):
         """Test user login endpoint"""
         # First register a user
@@ -173,6 +206,63 @@ class TestDatabaseOperations(unittest.TestCase):
             self.assertEqual(log.action, "test_action")
             self.assertIsNotNone(log.timestamp)
 
+    def test_purge_audit_logs_keeps_recent_entries(self):
+        """Test that retention cleanup deletes only entries older than the retention period"""
+        action = f"purge_{uuid.uuid4().hex[:8]}"
+        # A retention of about 50 years keeps the fixture data; entries sit an hour either side
+        # of the cutoff, so a cutoff taken in local time instead of UTC gets one of them wrong
+        retention_days = 50 * 365
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        with Session(engine) as session:
+            for name, offset in (("day_before", timedelta(days=-1)), ("hour_before", timedelta(hours=-1)),
+                                 ("hour_after", timedelta(hours=1))):
+                session.add(AuditLog(user_id=0, action=action, target_type="system", target_id=name,
+                                     timestamp=cutoff + offset))
+            session.commit()
+        retention, batch_size = main.AUDIT_TRAIL_RETENTION_DAYS, main.AUDIT_TRAIL_CLEANUP_BATCH_SIZE
+        # A batch size of 1 makes it loop
+        main.AUDIT_TRAIL_RETENTION_DAYS, main.AUDIT_TRAIL_CLEANUP_BATCH_SIZE = retention_days, 1
+        try:
+            self.assertGreaterEqual(main.purge_audit_logs(), 2)
+        finally:
+            main.AUDIT_TRAIL_RETENTION_DAYS, main.AUDIT_TRAIL_CLEANUP_BATCH_SIZE = retention, batch_size
+        with Session(engine) as session:
+            kept = session.exec(select(AuditLog.target_id).where(AuditLog.action == action)).all()
+        self.assertEqual(kept, ["hour_after"])
+
+    def test_audit_trail_level_skips_lower_event_classes(self):
+        """Test that AUDIT_TRAIL_LEVEL drops lower event classes but always keeps logins"""
+        target = uuid.uuid4().hex[:8]
+        main._audit_min_class = main.AUDIT_TRAIL_LEVELS["writes_only"]
+        try:
+            enqueue_audit(0, "data_exported", "system", target)
+            enqueue_audit(0, "user_deleted", "user", target)
+            main._audit_min_class = main.AUDIT_TRAIL_LEVELS["deletes_only"]
+            enqueue_audit(0, "user_login", "user", target)
+        finally:
+            main._audit_min_class = main.AUDIT_TRAIL_LEVELS[main.AUDIT_TRAIL_LEVEL]
+        with Session(engine) as session:
+            written = session.exec(select(AuditLog.action).where(AuditLog.target_id == target)).all()
+        self.assertEqual(sorted(written), ["user_deleted", "user_login"])
+
+    def test_audit_flusher_writes_queued_entries(self):
+        """Test that buffered audit entries are all written at shutdown, including any behind the sentinel"""
+        action = f"flush_{uuid.uuid4().hex[:8]}"
+        main._audit_flusher_running = True
+        try:
+            for i in range(3):
+                enqueue_audit(0, action, "system", str(i))
+        finally:
+            main._audit_flusher_running = False
+        main._audit_queue.put(None)
+        # Queued behind the sentinel, as a thread racing shutdown could do
+        main._audit_queue.put_nowait(main.build_log(0, action, "system", "3").model_dump(exclude={"id"}))
+        audit_flusher()
+        main.drain_audit_queue()
+        with Session(engine) as session:
+            written = session.exec(select(AuditLog.target_id).where(AuditLog.action == action)).all()
+        self.assertEqual(sorted(written), ["0", "1", "2", "3"])
+
 
 class TestNFCOperations(unittest.TestCase):
     """Test NFC-related operations and tag registration"""
@@ -274,6 +364,22 @@ class TestNFCOperations(unittest.TestCase):
         self.assertEqual(data["teacher_name"], "teacher2")
 
 
+    def test_register_duty_teacher_takes_over_duty(self):
+        """Test registering a duty teacher while another teacher is already on duty"""
+        names = [f"duty_{i}_{uuid.uuid4().hex[:8]}" for i in range(2)]
+        for name in names:
+            response = self.client.post("/register", json={
+                "username": name,
+                "password": "testpass123",
+                "role": UserRole.TEACHER,
+                "assigned_duty": True
+            })
+            self.assertEqual(response.status_code, 200)
+
+        with Session(engine) as session:
+            on_duty = session.exec(select(User.name).where(User.assigned_duty == True)).all()
+        self.assertEqual(on_duty, [names[1]])
+
 class TestStudentManagement(unittest.TestCase):
     """Test student management and registration endpoints"""
     
@@ -304,7 +410,59 @@ class TestStudentManagement(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         data = response.json()
         self.assertIn("students", data)
-        
+
+    def test_get_students_pagination(self):
+        """Test paging through students with limit and after_id"""
+        self.client.post("/register", json={
+            "username": "teachertest2",
+            "password": "testpass123",
+            "role": UserRole.TEACHER
+        })
+        login_response = self.client.post("/login", json={
+            "username": "teachertest2",
+            "password": "testpass123"
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+        with Session(engine) as session:
+            for i in range(3):
+                session.add(Student(name=f"Page Student {i}", tid="", lastscan=int(time.time()), in_school=False))
+            session.commit()
+
+        all_ids = [s["id"] for s in self.client.get("/students", headers=headers).json()["students"]]
+        first = self.client.get("/students", params={"limit": 2}, headers=headers).json()["students"]
+        self.assertEqual([s["id"] for s in first], all_ids[:2])
+        rest = self.client.get("/students", params={"limit": 1000, "after_id": first[-1]["id"]},
+                               headers=headers).json()["students"]
+        self.assertEqual([s["id"] for s in rest], all_ids[2:])
+
+    def test_check_in_logs_before_cursor(self):
+        """Test paging through check-in logs with limit and before"""
+        self.client.post("/register", json={
+            "username": "teachertest4",
+            "password": "testpass123",
+            "role": UserRole.TEACHER
+        })
+        login_response = self.client.post("/login", json={
+            "username": "teachertest4",
+            "password": "testpass123"
+        })
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+        with Session(engine) as session:
+            for i in range(3):
+                session.add(AuditLog(user_id=1, action="check_in_with_duty_teacher", target_type="user",
+                                     timestamp=datetime(2000, 1, 1, 8, 0, i)))
+            session.commit()
+
+        newest = self.client.get("/teacher/check-in-logs", params={"limit": 1000}, headers=headers).json()["logs"]
+        timestamps = [log["timestamp"] for log in newest]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+        older = self.client.get("/teacher/check-in-logs", params={"before": "2000-01-01T08:00:02"},
+                                headers=headers).json()["logs"]
+        self.assertEqual(older[0]["timestamp"], "2000-01-01T08:00:01")
+        self.assertTrue(all(log["timestamp"] < "2000-01-01T08:00:02" for log in older))
+
     def test_register_tag_missing_name(self):
         """Test tag registration with missing student name"""
         # Register a teacher
@@ -362,6 +520,26 @@ class TestStudentManagement(unittest.TestCase):
         # Should fail because no NFC reader available in test environment
         self.assertEqual(response.status_code, 503)
 
+    def test_new_tag_accepts_id_only_body(self):
+        """Test /newTag only needs the student id in the body"""
+        teacher_data = {
+            "username": "teachertest5",
+            "password": "testpass123",
+            "role": UserRole.TEACHER
+        }
+        self.client.post("/register", json=teacher_data)
+
+        login_response = self.client.post("/login", json={
+            "username": "teachertest5",
+            "password": "testpass123"
+        })
+        token = login_response.json()["access_token"]
+
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.post("/newTag", json={"id": 1}, headers=headers)
+        # Body validates; fails only because no NFC reader is available
+        self.assertEqual(response.status_code, 503)
+
 
 class TestCheckInOut(unittest.TestCase):
     """Test check-in/out functionality"""
@@ -393,7 +571,40 @@ class TestCheckInOut(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         data = response.json()
         self.assertIn("students", data)
-        
+
+        # The cached status must pick up a student added through the API
+        name = f"Status Student {uuid.uuid4().hex[:8]}"
+        self.client.post("/teacher/students", json={"name": name, "class_name": "1A"}, headers=headers)
+        data = self.client.get("/teacher/check-in-status", headers=headers).json()
+        self.assertIn(name, [s["name"] for s in data["students"]])
+        self.assertEqual(data["total"], len(data["students"]))
+        self.assertEqual(data["in_school_count"], sum(s["in_school"] for s in data["students"]))
+        
+    def test_process_nfc_scan_flips_status(self):
+        """Test that each tap flips in_school and writes a check-in/out log"""
+        tid = uuid.uuid4().hex
+        with Session(engine) as session:
+            student = Student(name=f"Tap Student {tid[:8]}", tid=tid, lastscan=0, in_school=False)
+            session.add(student)
+            session.commit()
+            student_id = student.id
+
+        process_nfc_scan(tid)
+        with Session(engine) as session:
+            self.assertTrue(session.get(Student, student_id).in_school)
+        process_nfc_scan(tid)
+        process_nfc_scan("unknown-" + tid)  # no student: nothing to update
+        with Session(engine) as session:
+            student = session.get(Student, student_id)
+            self.assertFalse(student.in_school)
+            self.assertGreater(student.lastscan, 0)
+            actions = session.exec(
+                select(AuditLog.action).where(AuditLog.target_id == str(student_id))
+                .where(AuditLog.details.contains(student.name))
+                .where(AuditLog.action.like("check_%_with_duty_teacher"))
+            ).all()
+            self.assertEqual(sorted(actions), ["check_in_with_duty_teacher", "check_out_with_duty_teacher"])
+
     def test_check_in_logs_endpoint(self):
         """Test check-in logs endpoint"""
         # Register a teacher
@@ -511,6 +722,7 @@ class TestAdminEndpoints(unittest.TestCase):
             "role": UserRole.TEACHER
         }
         self.client.post("/register", json=teacher_data)
+        self.teacher_username = teacher_data["username"]
         
         login_data = {
             "username": teacher_data["username"],
@@ -595,6 +807,22 @@ class TestAdminEndpoints(unittest.TestCase):
         for field in required_fields:
             self.assertIn(field, data)
             
+    def test_admin_system_metrics_today_checkins(self):
+        """Test that today_checkins counts only check-ins logged since midnight"""
+        token = self.setup_admin_user()
+        headers = {"Authorization": f"Bearer {token}"}
+        before = self.client.get("/admin/system-metrics", headers=headers).json()
+
+        with Session(engine) as session:
+            for timestamp in (datetime.now(), datetime.now() - timedelta(days=1)):
+                session.add(AuditLog(user_id=0, action="check_in_with_duty_teacher", target_type="user",
+                                     timestamp=timestamp))
+            session.commit()
+
+        after = self.client.get("/admin/system-metrics", headers=headers).json()
+        self.assertEqual(after["today_checkins"] - before["today_checkins"], 1)
+        self.assertEqual(after["total_checkins"] - before["total_checkins"], 2)
+
     def test_admin_system_config_endpoint(self):
         """Test admin system configuration endpoint"""
         # Setup admin user
@@ -762,7 +990,7 @@ class TestAdminEndpoints(unittest.TestCase):
         
         # Get teacher user ID
         login_response = self.client.post("/login", json={
-            "username": f"teacher_{int(time.time())}",
+            "username": self.teacher_username,
             "password": "teacherpass123"
         })
         teacher_id = login_response.json()["user_id"]
@@ -782,7 +1010,7 @@ class TestAdminEndpoints(unittest.TestCase):
         
         # Get teacher user ID
         login_response = self.client.post("/login", json={
-            "username": f"teacher_{int(time.time())}",
+            "username": self.teacher_username,
             "password": "teacherpass123"
         })
         teacher_id = login_response.json()["user_id"]
@@ -799,6 +1027,29 @@ class TestAdminEndpoints(unittest.TestCase):
                                  headers=admin_headers)
         self.assertEqual(response.status_code, 200)
 
+    def test_deactivated_user_rejected_immediately(self):
+        """Test deactivation takes effect even though authenticated users are cached"""
+        admin_token = self.setup_admin_user()
+        teacher_token = self.setup_teacher_user()
+        teacher_headers = {"Authorization": f"Bearer {teacher_token}"}
+
+        # Authenticated request puts the teacher in the user cache
+        response = self.client.get("/teacher/current-duty", headers=teacher_headers)
+        self.assertEqual(response.status_code, 200)
+
+        login_response = self.client.post("/login", json={
+            "username": self.teacher_username,
+            "password": "teacherpass123"
+        })
+        teacher_id = login_response.json()["user_id"]
+        admin_headers = {"Authorization": f"Bearer {admin_token}"}
+        response = self.client.get(f"/admin/users/{teacher_id}/deactivate",
+                                 headers=admin_headers)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get("/teacher/current-duty", headers=teacher_headers)
+        self.assertEqual(response.status_code, 400)
+
 
 class TestITStaffEndpoints(unittest.TestCase):
     """Test IT staff-level endpoints"""